@@ -9,9 +9,10 @@
 import glob
 import os
 import struct
-import xml.dom.minidom as X
+import xml.etree.ElementTree as ET
 
 from Common import *
+from Manifest import *
 
 
 class SoundBank:
@@ -22,6 +23,11 @@ class SoundBank:
     FILE = 'BastionSoundBank.xsb'
     VERSION = 0x5
 
+    HEADER = struct.Struct('<IQ')
+    UINT = struct.Struct('<I')
+    FILE_ID = struct.Struct('<IB')
+    STRING_LEN = struct.Struct('<H')
+
     def __init__(self, file_path):
         """Opens the sound bank."""
 
@@ -40,47 +46,74 @@ class SoundBank:
             raise AudioError('Failed to open sound bank file.')
 
     def parse_xsb_file(self, f):
-        """Parses an XSB file for sound bank entries."""
+        """Parses an XSB file for sound bank entries.
+
+        The whole file is read at once, then parsed from memory."""
+
+        try:
+            return self.parse_xsb_data(f.read())
+        except (struct.error, UnicodeDecodeError, IndexError):
+            raise AudioError('Invalid XSB file.')
+
+    def parse_xsb_data(self, data):
+        """Parses an XSB file's data for sound bank entries."""
 
-        data = []
+        sounds = []
+        uint = SoundBank.UINT.unpack_from
+        file_id = SoundBank.FILE_ID.unpack_from
+        string_len = SoundBank.STRING_LEN.unpack_from
+
+        def read_string(pos):
+            s_len = string_len(data, pos)[0]
+            pos += 2
+            if not s_len:
+                return None, pos
+            return data[pos:pos + s_len].decode('ascii'), pos + s_len
 
         # Load the XSB header.
-        self.version, self.num_sounds = struct.unpack('<IQ', f.read(0xC))
+        self.version, self.num_sounds = SoundBank.HEADER.unpack_from(data)
         if self.version != SoundBank.VERSION:
             raise AudioError('Invalid XSB version.')
+        pos = SoundBank.HEADER.size
 
         # Load the sounds.
-        n = 0
-        while n < self.num_sounds:
+        for n in range(self.num_sounds):
 
             # Load the sound entries.
-            u1 = f.read(4)
-            u2 = f.read(4)
-            entries_num = struct.unpack('<I', f.read(0x4))[0]
+            u1 = data[pos:pos + 4]
+            u2 = data[pos + 4:pos + 8]
+            entries_num = uint(data, pos + 8)[0]
+            pos += 12
             entries = []
-            for e in range(0, entries_num):
-                files_num = struct.unpack('<I', f.read(0x4))[0]
+            for e in range(entries_num):
+                files_num = uint(data, pos)[0]
+                pos += 4
                 files = []
-                for f_i in range(0, files_num):
-                    bank_name = read_string(f, 2)
-                    file_num = struct.unpack('<Ix', f.read(0x5))[0]
-                    files.append({'Bank': bank_name, 'Id': file_num})
-                u3 = f.read(0x2A)  # Unknown data.
+                for f_i in range(files_num):
+                    bank_name, pos = read_string(pos)
+                    f_id, u7 = file_id(data, pos)  # Unknown byte.
+                    files.append({'Bank': bank_name, 'Id': f_id,
+                        'Unknown7': bytes((u7,))})
+                    pos += 5
+                u3 = data[pos:pos + 0x2A]  # Unknown data.
+                pos += 0x2A
                 entries.append({'Files': files, 'Unknown3': u3})
-            category = read_string(f, 2)
+            category, pos = read_string(pos)
 
             # Load the sound's properties.
             properties = reverb = None
             if entries_num:
-                properties_num = struct.unpack('<I', f.read(0x4))[0]
+                properties_num = uint(data, pos)[0]
+                pos += 4
                 properties = []
-                for prop in range(0, properties_num):
-                    prop_name = read_string(f, 2)
+                for prop in range(properties_num):
+                    prop_name, pos = read_string(pos)
                     properties.append(prop_name)
 
-                reverb = read_string(f, 2)
+                reverb, pos = read_string(pos)
 
-            u4 = f.read(0x4)  # Unknown data.
+            u4 = data[pos:pos + 4]  # Unknown data.
+            pos += 4
 
             # Prepare the data before returning it.
             sound = {
@@ -95,95 +128,243 @@ class SoundBank:
                 # The following will be filled during the name loop.
                 'Name': None,
                 'Unknown5': None,
-                'Unknown6': None
+                'Unknown6': None,
+                'NameEntry': None,
+                'NameOrder': None
             }
-            data.append(sound)
+            sounds.append(sound)
+
+        # Load the sounds' names, which fill the rest of the file. Each
+        # sound's entry in the name table, and its order in it, are kept so
+        # that the table can be written back as is.
+        n = 0
+        while pos < len(data):
+            name, pos = read_string(pos)
+            u5 = data[pos:pos + 4]
+            num_data_num = uint(data, pos + 4)[0]
+            pos += 8
+            data_nums = struct.unpack_from('<{}I'.format(num_data_num), data,
+                pos)
+            pos += 4 * num_data_num
+            u6 = data[pos:pos + 4]
+            pos += 4
+            for i, data_num in enumerate(data_nums):
+                sounds[data_num]['Name'] = name
+                sounds[data_num]['Unknown5'] = u5
+                sounds[data_num]['Unknown6'] = u6
+                sounds[data_num]['NameEntry'] = n
+                sounds[data_num]['NameOrder'] = i
             n += 1
 
-        # Load the sounds' names.
-        while f.read(1):
-            f.seek(-1, 1)
-            name = read_string(f, 2)
-            u5 = f.read(4)
-            num_data_num = struct.unpack('<I', f.read(4))[0]
-            data_nums = []
-            for i in range(0, num_data_num):
-                data_num = struct.unpack('<I', f.read(4))[0]
-                data_nums.append(data_num)
-            u6 = f.read(4)
-            for data_num in data_nums:
-                data[data_num]['Name'] = name
-                data[data_num]['Unknown5'] = u5
-                data[data_num]['Unknown6'] = u6
+        return sounds
 
-        return data
+    def parse_xml_file(self, f):
+        """Parses an XML file, as saved by save_xml(), for sound bank entries.
+
+        The file is parsed as a stream: each sound's element is emptied once
+        it has been read."""
+
+        sounds = []
+        try:
+            for event, e in ET.iterparse(f):
+                if e.tag == 'Sound':
+                    sounds.append(self.parse_xml_sound(e))
+                    e.clear()
+        except (ET.ParseError, TypeError, ValueError):
+            raise AudioError('Invalid XML sound bank.')
+
+        self.version = SoundBank.VERSION
+        self.num_sounds = len(sounds)
+        return sounds
+
+    def parse_xml_sound(self, element):
+        """Parses a sound's XML element."""
+
+        sound = {
+            'Entries': [],
+            'Category': element.get('Category'),
+            'Properties': [],
+            'Reverb': None,
+            'Name': element.get('Name'),
+            'NameEntry': None,
+            'NameOrder': None
+        }
+        if element.get('NameEntry') is not None:
+            sound['NameEntry'] = int(element.get('NameEntry'))
+            sound['NameOrder'] = int(element.get('NameOrder'))
+        for u in ('1', '2', '4', '5', '6'):
+            sound['Unknown' + u] = None
+        for child in element:
+            if child.tag == 'Entry':
+                files = []
+                u3 = None
+                for e in child:
+                    if e.tag == 'File':
+                        u7 = e.find('RawData')
+                        files.append({'Bank': e.get('Bank'),
+                            'Id': int(e.get('Id')),
+                            'Unknown7': None if u7 is None else
+                                bytes.fromhex(u7.get('Value'))})
+                    elif e.tag == 'RawData':
+                        u3 = bytes.fromhex(e.get('Value'))
+                sound['Entries'].append({'Files': files, 'Unknown3': u3})
+            elif child.tag == 'RawData':
+                sound['Unknown' + child.get('Id')] = bytes.fromhex(
+                    child.get('Value'))
+            elif child.tag == 'Property':
+                sound['Properties'].append(child.text or None)
+            elif child.tag == 'Reverb':
+                sound['Reverb'] = child.text or None
+
+        # Sounds without entries have neither properties nor reverb.
+        if not sound['Entries']:
+            sound['Properties'] = None
+        return sound
 
     def save_xsb(self, file_path):
         """Saves the sound bank's data to an XSB file."""
 
         try:
-            f = open(file_path, 'wb')
+            data = self.build_xsb()
+        except (KeyError, TypeError, struct.error):
+            raise AudioError('Invalid sound bank data.')
+        try:
+            with open(file_path, 'wb') as f:
+                f.write(data)
         except (OSError, IOError):
             raise AudioError('Failed to save Sound Bank file for writing.')
-        f.close()
+
+    def build_xsb(self):
+        """Builds the sound bank's XSB data.
+
+        The sounds are listed in the name table at their original position.
+        Missing unknown bytes after the file ids are written as 0, and the
+        sounds without a position are added to the table in order, under
+        their name's first entry."""
+
+        def raw(b, size):
+            if len(b) != size:
+                raise AudioError('Invalid sound bank raw data size.')
+            return b
+
+        uint = SoundBank.UINT.pack
+        file_id = SoundBank.FILE_ID.pack
+
+        # Write the sounds.
+        data = bytearray(SoundBank.HEADER.pack(SoundBank.VERSION,
+            len(self.data)))
+        for sound in self.data:
+            data += raw(sound['Unknown1'], 4)
+            data += raw(sound['Unknown2'], 4)
+            data += uint(len(sound['Entries']))
+            for entry in sound['Entries']:
+                data += uint(len(entry['Files']))
+                for file_e in entry['Files']:
+                    data += pack_string(file_e['Bank'], 2)
+                    u7 = file_e.get('Unknown7')
+                    data += file_id(file_e['Id'], raw(u7, 1)[0] if u7 else 0)
+                data += raw(entry['Unknown3'], 0x2A)
+            data += pack_string(sound['Category'], 2)
+            if sound['Entries']:
+                data += uint(len(sound['Properties']))
+                for prop_name in sound['Properties']:
+                    data += pack_string(prop_name, 2)
+                data += pack_string(sound['Reverb'], 2)
+            data += raw(sound['Unknown4'], 4)
+
+        # Sort the named sounds into the name table's entries.
+        positions = {}
+        unsorted = []
+        for i, sound in enumerate(self.data):
+            if sound['Name'] is None:
+                continue
+            if sound.get('NameEntry') is not None:
+                positions.setdefault((sound['NameEntry'], sound['Name']),
+                    []).append((sound['NameOrder'], i))
+            else:
+                unsorted.append(i)
+        table = [(name, [i for pos, i in sorted(p)])
+            for (n, name), p in sorted(positions.items())]
+        names = dict((name, data_nums) for name, data_nums in reversed(table))
+        for i in unsorted:
+            name = self.data[i]['Name']
+            if name not in names:
+                names[name] = []
+                table.append((name, names[name]))
+            names[name].append(i)
+
+        # Write the sounds' names.
+        for name, data_nums in table:
+            sound = self.data[data_nums[0]]
+            data += pack_string(name, 2)
+            data += raw(sound['Unknown5'], 4)
+            data += struct.pack('<{}I'.format(len(data_nums) + 1),
+                len(data_nums), *data_nums)
+            data += raw(sound['Unknown6'], 4)
+
+        return data
 
     def save_xml(self, file_path):
         """Saves the sound bank's data to an XML file."""
 
-        # Build the XML data.
-        impl = X.getDOMImplementation()
-        doc = impl.createDocument(None, 'SoundBank', None)
-        root = doc.documentElement
-        for i, b in enumerate(self.data):
-            sound = doc.createElement('Sound')
-            sound.setAttribute('Id', str(i))
-            if b['Name'] is not None:
-                sound.setAttribute('Name', str(b['Name']))
-            if b['Category'] is not None:
-                sound.setAttribute('Category', str(b['Category']))
-            if b['Reverb'] is not None:
-                reverb = doc.createElement('Reverb')
-                reverb.appendChild(doc.createTextNode(str(b['Reverb'])))
-                sound.appendChild(reverb)
-
-            # Add the entries.
-            if b['Entries'] is not None:
-                for e in b['Entries']:
-                    entry = doc.createElement('Entry')
-                    for s in e['Files']:
-                        file_e = doc.createElement('File')
-                        file_e.setAttribute('Bank', str(s['Bank']))
-                        file_e.setAttribute('Id', str(s['Id']))
-                        entry.appendChild(file_e)
-                    unknown3 = doc.createElement('RawData')
-                    unknown3.setAttribute('Id', '3')
-                    unknown3.setAttribute('Value', F(e['Unknown3']))
-                    entry.appendChild(unknown3)
-                    sound.appendChild(entry)
-
-            # Add the unknown blocks of data.
-            for u in ('1', '2', '4', '5', '6'):
-                if b['Unknown' + u] is not None:
-                    unknown = doc.createElement('RawData')
-                    unknown.setAttribute('Id', u)
-                    unknown.setAttribute('Value', F(b['Unknown' + u]))
-                    sound.appendChild(unknown)
-
-            root.appendChild(sound)
-
-        # Write the XML data.
-        xml_data = doc.toprettyxml(encoding='utf-8')
+        # Write the XML data, one sound at a time.
         try:
-            with open(file_path, 'wb') as f:
-                f.write(xml_data)
+            with open(file_path, 'w', encoding='utf-8', newline='') as f:
+                xml = XMLWriter(f)
+                xml.start('SoundBank')
+                for i, b in enumerate(self.data):
+                    attributes = [('Id', str(i))]
+                    if b['Name'] is not None:
+                        attributes.append(('Name', str(b['Name'])))
+                    if b['Category'] is not None:
+                        attributes.append(('Category', str(b['Category'])))
+
+                    # The sound's entry in the name table, and its order in
+                    # it. They aren't XSB data, only where the table lists
+                    # the sound.
+                    if b.get('NameEntry') is not None:
+                        attributes.append(('NameEntry', str(b['NameEntry'])))
+                        attributes.append(('NameOrder', str(b['NameOrder'])))
+                    xml.start('Sound', attributes)
+                    if b['Reverb'] is not None:
+                        xml.element('Reverb', text=str(b['Reverb']))
+                    if b['Properties'] is not None:
+                        for p in b['Properties']:
+                            xml.element('Property',
+                                text=None if p is None else str(p))
+
+                    # Add the entries.
+                    if b['Entries'] is not None:
+                        for e in b['Entries']:
+                            xml.start('Entry')
+                            for s in e['Files']:
+                                xml.start('File', (('Bank', str(s['Bank'])),
+                                    ('Id', str(s['Id']))))
+                                if s.get('Unknown7') is not None:
+                                    xml.element('RawData', (('Id', '7'),
+                                        ('Value', F(s['Unknown7']))))
+                                xml.end()
+                            xml.element('RawData', (('Id', '3'),
+                                ('Value', F(e['Unknown3']))))
+                            xml.end()
+
+                    # Add the unknown blocks of data.
+                    for u in ('1', '2', '4', '5', '6'):
+                        if b['Unknown' + u] is not None:
+                            xml.element('RawData', (('Id', u),
+                                ('Value', F(b['Unknown' + u]))))
+                    xml.end()
+                xml.end()
         except (OSError, IOError):
             raise AudioError('Failed to write XML Sound Bank.')
 
 
 class WaveBank:
-    """Stores the sizes and (usually) the data of sound files.
+    """Locates sound files, stored in XWB files or in their own streaming
+    files.
 
-    Stored in XWB files."""
+    Only the path, offset and size of each sound file are kept: the data is
+    copied straight to the Ogg files when writing them."""
 
     VERSION = 0x5
 
@@ -201,7 +382,9 @@ class WaveBank:
             raise AudioError('Failed to open sound bank file.')
 
     def parse_file(self, f, streaming_dir):
-        """Parses an XWB file for Ogg files."""
+        """Parses an XWB file for Ogg files.
+
+        Returns the path, offset and size of each file."""
 
         files = []
 
@@ -215,17 +398,21 @@ class WaveBank:
         for i in range(0, self.num_files):
             file_sizes.append(struct.unpack('<Q', f.read(0x8))[0])
 
-        # Either load the files from the same file, or load their individual
-        # streaming files.
+        # The files are either stored in the same file, or in their
+        # individual streaming files.
         if self.name != 'StreamingWaveBank':
+            offset = f.tell()
+            end = os.fstat(f.fileno()).st_size
             for size in file_sizes:
-                files.append(f.read(size))
+                if offset + size > end:
+                    raise AudioError('Invalid XWB file.')
+                files.append((f.name, offset, size))
+                offset += size
         elif streaming_dir:
             for i, size in enumerate(file_sizes):
                 s_path = os.path.join(streaming_dir, '{}.ogg'.format(i))
                 try:
-                    with open(s_path, 'rb') as s:
-                        files.append(s.read())
+                    files.append((s_path, 0, os.path.getsize(s_path)))
                 except (OSError, IOError):
                     raise AudioError('Failed to open streaming audio file.')
 
@@ -235,14 +422,14 @@ class WaveBank:
         """Writes the file to an Ogg file."""
 
         try:
-            data = self.files[file_id]
+            src_path, offset, size = self.files[file_id]
         except IndexError:
             raise AudioError('The specified file could not be found.')
         try:
-            with open(file_path, 'wb') as f:
-                f.write(data)
-        except (OSError, IOError):
-            raise AudioError('Failed to write audio file.')
+            with open(src_path, 'rb') as src, open(file_path, 'wb') as dst:
+                copy_range(src, dst, offset, size)
+        except (OSError, IOError, EOFError):
+            raise AudioError('Failed to write {}.'.format(file_path))
 
 class Audio(BastionModule):
     """Extracts and compiles audio files."""
@@ -252,34 +439,83 @@ class Audio(BastionModule):
     CONTENT_DIR = 'Audio'
     EXTRACT_DIR = 'Audio'
 
+    def __init__(self, debug=False, audio_links='hardlink', **options):
+        """Initializes the module.
+
+        audio_links is how the later references to an already extracted
+        sound file are written, see link_file()."""
+
+        super().__init__(debug, **options)
+        self.audio_links = audio_links
+
     def extract(self, audio_dir, extract_dir):
         """Extracts the audio data."""
 
         super().extract(audio_dir, extract_dir)
 
+        # Skip the extraction if none of the banks have changed.
+        xsb_file = os.path.join(audio_dir, SoundBank.FILE)
+        xwb_files = glob.glob(os.path.join(audio_dir, '*.xwb'))
+        inputs = [xsb_file] + xwb_files + glob.glob(
+            os.path.join(audio_dir, 'Streaming', '*.ogg'))
+        manifest = Manifest(extract_dir, self.force)
+        if manifest.is_fresh('Audio', inputs):
+            print('  Skipping unchanged audio files.')
+            manifest.save()
+            return
+
         # Load the sound bank data and write it to XML.
-        sound_bank = SoundBank(os.path.join(audio_dir, SoundBank.FILE))
+        sound_bank = SoundBank(xsb_file)
         xml_path = os.path.join(extract_dir, 'SoundBank.xml')
         sound_bank.save_xml(xml_path)
+        outputs = [xml_path]
 
         # Load the wave bank data.
-        xwb_files = glob.glob(os.path.join(audio_dir, '*.xwb'))
         wave_banks = {}
         for f in xwb_files:
             wave_bank = WaveBank(f, os.path.join(audio_dir, 'Streaming'))
             wave_banks[wave_bank.name] = wave_bank
 
-        # Output the files into their categories' folders.
+        # Output the files into their categories' folders. Each sound file is
+        # only written once, the later references being linked to it.
+        extracted = {}
         for sound in sound_bank.data:
+            self.check_stop()
             sound_dir = os.path.join(extract_dir, sound['Category'])
             for entry in sound['Entries']:
                 file_dir = os.path.join(sound_dir, sound['Name'])
-                if not os.path.exists(file_dir):
-                    os.makedirs(file_dir)
+                try:
+                    os.makedirs(file_dir, exist_ok=True)
+                except OSError:
+                    raise AudioError('Failed to create {}.'.format(file_dir))
                 for file_e in entry['Files']:
                     file_path = os.path.join(file_dir,
                         '{}_{}.ogg'.format(file_e['Bank'], file_e['Id']))
-                    bank = wave_banks[file_e['Bank']]
-                    bank.write_ogg(file_e['Id'], file_path)
-
-MODULES.append(Audio)
+                    key = (file_e['Bank'], file_e['Id'])
+                    try:
+                        if key in extracted:
+                            if extracted[key] != file_path:
+                                link_file(extracted[key], file_path,
+                                    self.audio_links)
+                        else:
+                            if os.path.lexists(file_path):
+                                os.remove(file_path)
+                            bank = wave_banks[file_e['Bank']]
+                            bank.write_ogg(file_e['Id'], file_path)
+                            extracted[key] = file_path
+                    except (OSError, IOError, EOFError):
+                        raise AudioError('Failed to write {}.'.format(
+                            file_path))
+                    outputs.append(file_path)
+
+        manifest.update('Audio', inputs, outputs)
+        manifest.save()
+
+    def compile(self, extract_dir, audio_dir):
+        """Compiles the audio data."""
+
+        super().compile(extract_dir, audio_dir)
+
+        # Rebuild the sound bank from its XML file.
+        sound_bank = SoundBank(os.path.join(extract_dir, 'SoundBank.xml'))
+        sound_bank.save_xsb(os.path.join(audio_dir, SoundBank.FILE))
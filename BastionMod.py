@@ -8,32 +8,112 @@
 # by Sam Hocevar. See the COPYING file for more details.
 
 from argparse import *
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
 from time import time
 
-from Audio import *
+from BastionModule import *
 from Common import *
-from Graphics import *
 
-def extract_data(content_dir, extract_dir, debug):
-    """Extracts Bastion game data from its 'Content' directory."""
+def extract_data(content_dir, extract_dir, debug, modules=None, **options):
+    """Extracts Bastion game data from its 'Content' directory.
 
-    # Run all the modules' extraction procedures.
-    for m in MODULES:
-        print('Extracting {}.'.format(m.DATA_TYPE))
+    modules is a list of the DATA_TYPEs of the modules to run, all of them
+    by default. The modules run concurrently, see run_modules()."""
+
+    run_modules('extract', content_dir, extract_dir, debug, modules,
+        **options)
+
+def compile_data(extract_dir, content_dir, debug, modules=None, **options):
+    """Compiles the extracted data back into the 'Content' directory.
+
+    modules is a list of the DATA_TYPEs of the modules to run, all of them
+    by default. The modules run concurrently, see run_modules()."""
+
+    run_modules('compile', content_dir, extract_dir, debug, modules,
+        **options)
+
+def select_modules(names=None):
+    """Returns the DATA_TYPEs of the listed modules, or of all of them."""
+
+    if not names:
+        return list(MODULES)
+    for name in names:
+        if name not in MODULES:
+            raise BastionModError('Unknown module: {} (available: {}).'
+                .format(name, ', '.join(MODULES)))
+    return [m for m in MODULES if m in names]
+
+def run_modules(action, content_dir, extract_dir, debug, modules=None,
+    **options):
+    """Runs the modules' extraction or compilation procedures concurrently.
+
+    action is either 'extract' or 'compile'. The modules read and write
+    disjoint directories, and mostly wait on I/O or on their own worker
+    processes, so each one runs in its own thread: all of them but the last
+    in a shared executor, and the last one in the calling thread. Only the
+    calling thread is interrupted by Ctrl+C: the other modules are then told
+    to stop, see BastionModule.check_stop(), without waiting for them.
+
+    Each module is only imported once it runs, see load_module(): a module
+    which fails to load is reported like any other error. The errors of all
+    the modules are reported together once they are done."""
+
+    selected = select_modules(modules)
+    verbs = {'extract': ('Extracting', 'Extracted'),
+        'compile': ('Compiling', 'Compiled')}[action]
+    done = []
+    errors = []
+
+    def run(data_type):
+        m = load_module(data_type)
         m_content_dir = os.path.join(content_dir, m.CONTENT_DIR)
         m_extract_dir = os.path.join(extract_dir, m.EXTRACT_DIR)
-        module = m(debug)
-        try:
+        module = m(debug, stop=stop, **options)
+        if action == 'extract':
             module.extract(m_content_dir, m_extract_dir)
-        except BastionModError as e:
-            raise BastionModError('Failed to extract {}: {}'.format(
-                m.DATA_TYPE, e))
         else:
-            print('Extracted {}.'.format(m.DATA_TYPE))
+            module.compile(m_extract_dir, m_content_dir)
+
+    def finish(data_type, e=None):
+        with lock:
+            done.append(data_type)
+            if e is None:
+                print('{} {} ({}/{}).'.format(verbs[1], data_type, len(done),
+                    len(selected)))
+            else:
+                errors.append('Failed to {} {}: {}'.format(action,
+                    data_type, format_error(e)))
 
-def compile_data(extract_dir, content_dir, debug):
-    """Compiles the extracted data back into the 'Content' directory."""
+    def run_finish(data_type):
+        try:
+            run(data_type)
+        except Exception as e:
+            finish(data_type, e)
+        else:
+            finish(data_type)
+
+    for data_type in selected:
+        print('{} {}.'.format(verbs[0], data_type))
+    lock = threading.Lock()
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max(1, len(selected) - 1))
+    try:
+        futures = [executor.submit(run_finish, data_type)
+            for data_type in selected[:-1]]
+        for data_type in selected[-1:]:
+            run_finish(data_type)
+        for future in futures:
+            future.result()
+    except BaseException:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    if errors:
+        raise BastionModError('\n'.join(errors))
 
 if __name__ == '__main__':
 
@@ -52,17 +132,68 @@ if __name__ == '__main__':
         help='Compile data back to Bastion.')
     parser.add_argument('-d', action='store_const', const=True, default=False,
         help='Enable debugging output.')
+    parser.add_argument('-j', type=int, default=1, metavar='N',
+        help='Number of files to process in parallel (default: 1).')
+    parser.add_argument('--max-memory', type=parse_size, metavar='SIZE',
+        help='Memory budget for parallel extraction (e.g. 512M, 8G).')
+    parser.add_argument('--force', action='store_const', const=True,
+        default=False, help='Extract all files, even unchanged ones.')
+    parser.add_argument('--only', action='append', metavar='GLOB',
+        help='Only extract the images whose names match (e.g. "Sprites/*"). '
+        'Implies --modules graphics.')
+    parser.add_argument('--format', choices=('png', 'dds'), default='png',
+        help='Output images to PNG files, or textures as is to DDS files.')
+    parser.add_argument('--png-level', type=int, choices=range(10),
+        metavar='LEVEL', help='PNG compression level, from 0 to 9.')
+    parser.add_argument('--png-fast', action='store_const', const=True,
+        default=False, help='Favor speed over size when writing PNG files.')
+    parser.add_argument('--png-recompress', action='store_const', const=True,
+        default=False, help='Recompress small PNG files once written.')
+    parser.add_argument('--output', choices=('dir', 'zip', 'tar'),
+        default='dir', help='Write the extracted images to a directory tree, '
+        'or to one archive per PKG.')
+    parser.add_argument('--cache', metavar='DIR',
+        help='Keep the decoded textures in DIR, to skip decoding them again.')
+    parser.add_argument('--cache-size', type=parse_size, default='1G',
+        metavar='SIZE', help='Maximum size of the cache (default: 1G).')
+    parser.add_argument('--audio-links', default='hardlink',
+        choices=('hardlink', 'symlink', 'reflink', 'copy'),
+        help='How repeated audio files are written (default: hardlink).')
+    parser.add_argument('--dxt-quality', default='normal',
+        choices=('fast', 'normal', 'best'),
+        help='Quality of the compiled DXT textures (default: normal).')
+    parser.add_argument('--no-lzx', action='store_const', const=True,
+        default=False, help="Don't LZX-compress the compiled textures.")
+    parser.add_argument('--repack', action='store_const', const=True,
+        default=False, help='Pack all the atlases again from scratch.')
+    parser.add_argument('--modules', metavar='NAMES',
+        type=lambda s: [n.strip().lower() for n in s.split(',') if n.strip()],
+        help='Only run the listed modules (e.g. "audio,graphics").')
     args = parser.parse_args()
 
+    # Selective extractions only apply to the graphics.
+    if args.only:
+        if args.modules and args.modules != ['graphics']:
+            parser.error('--only can only be used with the graphics module.')
+        args.modules = ['graphics']
+
     try:
         start_time = time()
         if args.e:
             print("Extracting from '{}'.".format(args.content))
-            extract_data(args.content, args.extracted, args.d)
+            extract_data(args.content, args.extracted, args.d, args.modules,
+                jobs=args.j, max_memory=args.max_memory, only=args.only,
+                force=args.force, output_format=args.format,
+                png_level=args.png_level, png_fast=args.png_fast,
+                png_recompress=args.png_recompress, output=args.output,
+                cache=args.cache, cache_size=args.cache_size,
+                audio_links=args.audio_links)
             print('Extraction complete.')
         else:
             print("Compiling to '{}'.".format(args.content))
-            compile_data(args.extracted, args.content, args.d)
+            compile_data(args.extracted, args.content, args.d, args.modules,
+                jobs=args.j, dxt_quality=args.dxt_quality, lzx=not args.no_lzx,
+                repack=args.repack)
             print('Compilation complete.')
         print('Time: {}s'.format(int(time() - start_time)))
     except KeyboardInterrupt:
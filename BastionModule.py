@@ -6,9 +6,30 @@
 # of the Do What The Fuck You Want To Public License, Version 2, as published
 # by Sam Hocevar. See the COPYING file for more details.
 
+import importlib
 import os
+import threading
 
-MODULES = []
+# The modules, by DATA_TYPE, along with the Python module defining each one's
+# class, named after it. They are only imported when they are run, see
+# load_module(), so that a run doesn't pay for the other modules' imports.
+MODULES = {
+    'audio': 'Audio',
+    'graphics': 'Graphics'
+}
+
+def load_module(data_type):
+    """Imports a module's class.
+
+    Raises BastionModError if the module can't be imported."""
+
+    from Common import BastionModError
+
+    name = MODULES[data_type]
+    try:
+        return getattr(importlib.import_module(name), name)
+    except ImportError as e:
+        raise BastionModError('Failed to load {}: {}'.format(name, e))
 
 
 class BastionModule:
@@ -19,10 +40,28 @@ class BastionModule:
     CONTENT_DIR = ''
     EXTRACT_DIR = ''
 
-    def __init__(self, debug=False):
-        """Initializes the module."""
+    def __init__(self, debug=False, jobs=1, force=False, stop=None,
+        **options):
+        """Initializes the module.
+
+        If force is True, files are extracted even if they are up to date.
+        stop is a threading.Event set when the module must stop, see
+        check_stop(). Options which aren't used by this module are
+        ignored."""
 
         self.debug = debug
+        self.jobs = max(1, jobs)
+        self.force = force
+        self.stop = stop or threading.Event()
+
+    def check_stop(self):
+        """Raises KeyboardInterrupt if the module must stop.
+
+        Only the main thread is interrupted by Ctrl+C: modules running in
+        other threads call this regularly instead."""
+
+        if self.stop.is_set():
+            raise KeyboardInterrupt
 
     def extract(self, content_dir, extract_dir):
         """To be extended by sub-classes."""
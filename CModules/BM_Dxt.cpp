@@ -8,43 +8,198 @@
  * by Sam Hocevar. See the COPYING file for more details.
  */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <squish.h>
 
 using namespace squish;
 
 // Converts DXT data to RGBA data.
-static PyObject* BM_Dxt_ToRgba(PyObject* self, PyObject* args)
+// The DXT data can be any object supporting the buffer protocol. The RGBA
+// data is written to the writable buffer passed as out, which is returned,
+// or to a new bytes object if there is none. The GIL is released while
+// decoding, so that several textures can be decoded from separate threads.
+static PyObject* BM_Dxt_ToRgba(PyObject* self, PyObject* args,
+    PyObject* kwargs)
 {
+    static const char* keywords[] = {
+        "version", "width", "height", "data", "out", NULL
+    };
     unsigned int version;
     unsigned int width;
     unsigned int height;
-    const char* inData;
-    unsigned int inLen;
+    Py_buffer inData;
+    PyObject* outObj = Py_None;
 
-    if (!PyArg_ParseTuple(args, "LLLy#",
-        &version, &width, &height, &inData, &inLen))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "IIIy*|O",
+        (char**)keywords, &version, &width, &height, &inData, &outObj))
         return NULL;
 
-    unsigned int outLen = 4 * width * height;
-    unsigned char* outData = new unsigned char[outLen];
     int flags = version & (kDxt1 | kDxt3 | kDxt5);
+    size_t blockSize = (flags & kDxt1) ? 8 : 16;
+    size_t inLen = ((size_t)(width + 3) / 4) * ((height + 3) / 4)
+        * blockSize;
+    size_t outLen = (size_t)4 * width * height;
+    if (!flags)
+    {
+        PyBuffer_Release(&inData);
+        PyErr_SetString(PyExc_ValueError, "Invalid DXT version.");
+        return NULL;
+    }
+    if ((size_t)inData.len < inLen)
+    {
+        PyBuffer_Release(&inData);
+        PyErr_SetString(PyExc_ValueError, "Not enough DXT data.");
+        return NULL;
+    }
+
+    // Get the buffer in which to write the RGBA data.
+    PyObject* result;
+    Py_buffer outData;
+    u8* out;
+    if (outObj == Py_None)
+    {
+        result = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)outLen);
+        if (!result)
+        {
+            PyBuffer_Release(&inData);
+            return NULL;
+        }
+        out = (u8*)PyBytes_AS_STRING(result);
+    }
+    else
+    {
+        if (PyObject_GetBuffer(outObj, &outData, PyBUF_WRITABLE) < 0)
+        {
+            PyBuffer_Release(&inData);
+            return NULL;
+        }
+        if ((size_t)outData.len < outLen)
+        {
+            PyBuffer_Release(&outData);
+            PyBuffer_Release(&inData);
+            PyErr_SetString(PyExc_ValueError, "Output buffer is too small.");
+            return NULL;
+        }
+        result = outObj;
+        Py_INCREF(result);
+        out = (u8*)outData.buf;
+    }
 
-    DecompressImage(outData, width, height, inData, flags);
-    return Py_BuildValue("y#", outData, outLen);
+    Py_BEGIN_ALLOW_THREADS
+    DecompressImage(out, width, height, inData.buf, flags);
+    Py_END_ALLOW_THREADS
+
+    if (outObj != Py_None)
+        PyBuffer_Release(&outData);
+    PyBuffer_Release(&inData);
+    return result;
 }
 
 // Converts RGBA data to DXT data.
-static PyObject* BM_Dxt_FromRgba(PyObject* self, PyObject* args)
+// The arguments are the same as to_rgba()'s, with the RGBA data as data and
+// the DXT data written to out. quality selects libsquish's colour fitting
+// method: 0 for range fit (fastest), 1 for cluster fit and 2 for iterative
+// cluster fit (best). The GIL is released while encoding, so that horizontal
+// bands of an image can be encoded from separate threads.
+static PyObject* BM_Dxt_FromRgba(PyObject* self, PyObject* args,
+    PyObject* kwargs)
 {
-    Py_RETURN_NONE;
+    static const char* keywords[] = {
+        "version", "width", "height", "data", "out", "quality", NULL
+    };
+    static const int fits[] = {
+        kColourRangeFit, kColourClusterFit, kColourIterativeClusterFit
+    };
+    unsigned int version;
+    unsigned int width;
+    unsigned int height;
+    Py_buffer inData;
+    PyObject* outObj = Py_None;
+    unsigned int quality = 1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "IIIy*|OI",
+        (char**)keywords, &version, &width, &height, &inData, &outObj,
+        &quality))
+        return NULL;
+
+    int flags = version & (kDxt1 | kDxt3 | kDxt5);
+    size_t blockSize = (flags & kDxt1) ? 8 : 16;
+    size_t inLen = (size_t)4 * width * height;
+    size_t outLen = ((size_t)(width + 3) / 4) * ((height + 3) / 4)
+        * blockSize;
+    if (!flags)
+    {
+        PyBuffer_Release(&inData);
+        PyErr_SetString(PyExc_ValueError, "Invalid DXT version.");
+        return NULL;
+    }
+    if (quality > 2)
+    {
+        PyBuffer_Release(&inData);
+        PyErr_SetString(PyExc_ValueError, "Invalid DXT quality.");
+        return NULL;
+    }
+    if ((size_t)inData.len < inLen)
+    {
+        PyBuffer_Release(&inData);
+        PyErr_SetString(PyExc_ValueError, "Not enough RGBA data.");
+        return NULL;
+    }
+
+    // Get the buffer in which to write the DXT data.
+    PyObject* result;
+    Py_buffer outData;
+    u8* out;
+    if (outObj == Py_None)
+    {
+        result = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)outLen);
+        if (!result)
+        {
+            PyBuffer_Release(&inData);
+            return NULL;
+        }
+        out = (u8*)PyBytes_AS_STRING(result);
+    }
+    else
+    {
+        if (PyObject_GetBuffer(outObj, &outData, PyBUF_WRITABLE) < 0)
+        {
+            PyBuffer_Release(&inData);
+            return NULL;
+        }
+        if ((size_t)outData.len < outLen)
+        {
+            PyBuffer_Release(&outData);
+            PyBuffer_Release(&inData);
+            PyErr_SetString(PyExc_ValueError, "Output buffer is too small.");
+            return NULL;
+        }
+        result = outObj;
+        Py_INCREF(result);
+        out = (u8*)outData.buf;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    CompressImage((const u8*)inData.buf, width, height, out,
+        flags | fits[quality]);
+    Py_END_ALLOW_THREADS
+
+    if (outObj != Py_None)
+        PyBuffer_Release(&outData);
+    PyBuffer_Release(&inData);
+    return result;
 }
 
 // DXT module methods.
 static PyMethodDef BM_DxtMethods[] = {
-    {"to_rgba", BM_Dxt_ToRgba, METH_VARARGS,
+    {"to_rgba", (PyCFunction)(void(*)(void))BM_Dxt_ToRgba,
+        METH_VARARGS | METH_KEYWORDS,
+        "to_rgba(version, width, height, data, out=None)\n"
         "Converts DXT data to RGBA data."},
-    {"from_rgba", BM_Dxt_FromRgba, METH_VARARGS,
+    {"from_rgba", (PyCFunction)(void(*)(void))BM_Dxt_FromRgba,
+        METH_VARARGS | METH_KEYWORDS,
+        "from_rgba(version, width, height, data, out=None, quality=1)\n"
         "Converts RGBA data to DXT data."},
 
     {NULL, NULL, 0, NULL}
@@ -1,6 +1,6 @@
 /**
  * BastionMod - Lzx
- * Decodes an XNB file using the LZX compression algorithm.
+ * Decodes and encodes XNB files using the LZX compression algorithm.
  * Based on https://bitbucket.org/alisci01/xnbdecompressor/
  *
  * Copyright © 2003-2004 Stuart Caie
@@ -15,24 +15,6 @@
 
 #include "BM_Lzx.h"
 
-/////////////////////////////////// UTILITY //////////////////////////////////
-void write_int32(std::stringstream& s, int i)
-{
-    s.put(i); s.put(i >> 8); s.put(i >> 16); s.put(i >> 24);
-}
-
-int read_int32(std::stringstream& s)
-{
-    char hi = s.get(), mh = s.get(), ml = s.get(), lo = s.get();
-    return (int)(hi | mh << 8 | ml << 16 | lo << 24);
-}
-
-unsigned int read_uint32(std::stringstream& s)
-{
-    char hi = s.get(), mh = s.get(), ml = s.get(), lo = s.get();
-    return (unsigned int)(hi | mh << 8 | ml << 16 | lo << 24);
-}
-
 ///////////////////////////////////// LZX ////////////////////////////////////
 LzxDecoder::LzxDecoder(int window)
 {
@@ -74,12 +56,18 @@ LzxDecoder::LzxDecoder(int window)
     m_state->intel_started = false;
 }
 
-int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
-    std::stringstream& outData, unsigned int outLen)
+LzxDecoder::~LzxDecoder()
 {
-    BitBuffer* bitbuf = new BitBuffer(&inData);
-    unsigned long startpos = inData.tellg();
-    unsigned long endpos = startpos + inLen;
+    delete[] m_state->window;
+    delete m_state;
+}
+
+int LzxDecoder::Decompress(const unsigned char* inData, size_t inSize,
+    size_t startpos, unsigned int inLen, unsigned char* outData,
+    unsigned int outLen)
+{
+    BitBuffer bitbuf(inData, inSize, startpos);
+    size_t endpos = startpos + inLen;
 
     char* window = m_state->window;
 
@@ -94,14 +82,14 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
         length_footer, extra, verbatim_bits;
     int rundest, runsrc, copy_length, aligned_bits;
 
-    bitbuf->InitBitStream();
+    bitbuf.InitBitStream();
 
     if (!m_state->header_read)
     {
-        if (bitbuf->ReadBits(1) != 0)
+        if (bitbuf.ReadBits(1) != 0)
         {
-            i = bitbuf->ReadBits(16);
-            j = bitbuf->ReadBits(16);
+            i = bitbuf.ReadBits(16);
+            j = bitbuf.ReadBits(16);
         }
         m_state->header_read = true;
     }
@@ -113,13 +101,13 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
             if (m_state->block_type == BLOCKTYPE_UNCOMPRESSED)
             {
                 if ((m_state->block_length & 1) == 1)
-                    inData.seekg(1, inData.cur);
-                bitbuf->InitBitStream();
+                    bitbuf.position++;
+                bitbuf.InitBitStream();
             }
 
-            m_state->block_type = bitbuf->ReadBits(3);
-            i = bitbuf->ReadBits(16);
-            j = bitbuf->ReadBits(8);
+            m_state->block_type = bitbuf.ReadBits(3);
+            i = bitbuf.ReadBits(16);
+            j = bitbuf.ReadBits(8);
             m_state->block_remaining = m_state->block_length
                                      = (unsigned int)((i << 8) | j);
 
@@ -127,35 +115,38 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
             {
             case BLOCKTYPE_ALIGNED:
                 for (i = 0, j = 0; i < 8; i++) {
-                    j = bitbuf->ReadBits(3);
+                    j = bitbuf.ReadBits(3);
                     m_state->ALIGNED_len[i] = (char)j;
                 }
-                MakeDecodeTable(ALIGNED_MAXSYMBOLS, ALIGNED_TABLEBITS,
-                    m_state->ALIGNED_len, m_state->ALIGNED_table);
+                if (MakeDecodeTable(ALIGNED_MAXSYMBOLS, ALIGNED_TABLEBITS,
+                    m_state->ALIGNED_len, m_state->ALIGNED_table))
+                    return -1;
 
             case BLOCKTYPE_VERBATIM:
-                ReadLengths(m_state->MAINTREE_len, 0, 256, bitbuf);
-                ReadLengths(m_state->MAINTREE_len, 256,
-                    m_state->main_elements, bitbuf);
-                MakeDecodeTable(MAINTREE_MAXSYMBOLS, MAINTREE_TABLEBITS,
-                    m_state->MAINTREE_len, m_state->MAINTREE_table);
+                if (ReadLengths(m_state->MAINTREE_len, 0, 256, &bitbuf)
+                    || ReadLengths(m_state->MAINTREE_len, 256,
+                        m_state->main_elements, &bitbuf)
+                    || MakeDecodeTable(MAINTREE_MAXSYMBOLS, MAINTREE_TABLEBITS,
+                        m_state->MAINTREE_len, m_state->MAINTREE_table))
+                    return -1;
                 if (m_state->MAINTREE_len[0xE8] != 0)
                     m_state->intel_started = true;
 
-                ReadLengths(m_state->LENGTH_len, 0, NUM_SECONDARY_LENGTHS,
-                    bitbuf);
-                MakeDecodeTable(LENGTH_MAXSYMBOLS, LENGTH_TABLEBITS,
-                    m_state->LENGTH_len, m_state->LENGTH_table);
+                if (ReadLengths(m_state->LENGTH_len, 0, NUM_SECONDARY_LENGTHS,
+                        &bitbuf)
+                    || MakeDecodeTable(LENGTH_MAXSYMBOLS, LENGTH_TABLEBITS,
+                        m_state->LENGTH_len, m_state->LENGTH_table))
+                    return -1;
                 break;
 
             case BLOCKTYPE_UNCOMPRESSED:
                 m_state->intel_started = true;
-                bitbuf->EnsureBits(16);
-                if (bitbuf->GetBitsLeft() > 16)
-                    inData.seekg(-2, inData.cur);
-                R0 = read_uint32(inData);
-                R1 = read_uint32(inData);
-                R2 = read_uint32(inData);
+                bitbuf.EnsureBits(16);
+                if (bitbuf.GetBitsLeft() > 16)
+                    bitbuf.position -= 2;
+                R0 = bitbuf.ReadUInt32();
+                R1 = bitbuf.ReadUInt32();
+                R2 = bitbuf.ReadUInt32();
                 break;
 
             default:
@@ -163,9 +154,8 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
             }
         }
 
-        if (inData.tellg() > (int)(startpos + inLen))
-            if (inData.tellg() > (int)(startpos + inLen + 2)
-                || bitbuf->GetBitsLeft() < 16)
+        if (bitbuf.position > endpos)
+            if (bitbuf.position > endpos + 2 || bitbuf.GetBitsLeft() < 16)
                 return -1;
 
         while ((this_run = (int)m_state->block_remaining) > 0 && togo > 0)
@@ -186,7 +176,7 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                 {
                     main_element = (int)ReadHuffSym(m_state->MAINTREE_table,
                         m_state->MAINTREE_len, MAINTREE_MAXSYMBOLS,
-                        MAINTREE_TABLEBITS, bitbuf);
+                        MAINTREE_TABLEBITS, &bitbuf);
                     if (main_element < NUM_CHARS)
                     {
                         window[window_posn++] = (char)main_element;
@@ -201,7 +191,7 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                         {
                             length_footer = (int)ReadHuffSym(
                                 m_state->LENGTH_table, m_state->LENGTH_len,
-                                LENGTH_MAXSYMBOLS, LENGTH_TABLEBITS, bitbuf);
+                                LENGTH_MAXSYMBOLS, LENGTH_TABLEBITS, &bitbuf);
                             match_length += length_footer;
                         }
                         match_length += MIN_MATCH;
@@ -213,7 +203,7 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                             if (match_offset != 3)
                             {
                                 extra = extra_bits[match_offset];
-                                verbatim_bits = (int)bitbuf->ReadBits(
+                                verbatim_bits = (int)bitbuf.ReadBits(
                                     (char)extra
                                 );
                                 match_offset = 
@@ -238,6 +228,11 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                             R2 = R0; R0 = (unsigned int)match_offset;
                         }
 
+                        if (match_offset <= 0
+                            || match_offset > (int)window_size
+                            || window_posn + match_length > window_size)
+                            return -1;
+
                         rundest = (int)window_posn;
                         this_run -= match_length;
 
@@ -270,7 +265,7 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                 {
                     main_element = (int)ReadHuffSym(m_state->MAINTREE_table,
                         m_state->MAINTREE_len, MAINTREE_MAXSYMBOLS,
-                        MAINTREE_TABLEBITS, bitbuf);
+                        MAINTREE_TABLEBITS, &bitbuf);
 
                     if (main_element < NUM_CHARS)
                     {
@@ -286,7 +281,7 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                         {
                             length_footer = (int)ReadHuffSym(
                                 m_state->LENGTH_table, m_state->LENGTH_len,
-                                LENGTH_MAXSYMBOLS, LENGTH_TABLEBITS, bitbuf);
+                                LENGTH_MAXSYMBOLS, LENGTH_TABLEBITS, &bitbuf);
                             match_length += length_footer;
                         }
                         match_length += MIN_MATCH;
@@ -301,13 +296,13 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                             if (extra > 3)
                             {
                                 extra -= 3;
-                                verbatim_bits = (int)bitbuf->ReadBits(
+                                verbatim_bits = (int)bitbuf.ReadBits(
                                     (char)extra);
                                 match_offset += (verbatim_bits << 3);
                                 aligned_bits = (int)ReadHuffSym(
                                     m_state->ALIGNED_table,
                                     m_state->ALIGNED_len, ALIGNED_MAXSYMBOLS,
-                                    ALIGNED_TABLEBITS, bitbuf);
+                                    ALIGNED_TABLEBITS, &bitbuf);
                                 match_offset += aligned_bits;
                             }
                             else if (extra == 3)
@@ -315,12 +310,12 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                                 aligned_bits = (int)ReadHuffSym(
                                     m_state->ALIGNED_table,
                                     m_state->ALIGNED_len, ALIGNED_MAXSYMBOLS,
-                                    ALIGNED_TABLEBITS, bitbuf);
+                                    ALIGNED_TABLEBITS, &bitbuf);
                                 match_offset += aligned_bits;
                             }
                             else if (extra > 0)
                             {
-                                verbatim_bits = (int)bitbuf->ReadBits(
+                                verbatim_bits = (int)bitbuf.ReadBits(
                                     (char)extra);
                                 match_offset += verbatim_bits;
                             }
@@ -342,6 +337,11 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                             R2 = R0; R0 = (unsigned int)match_offset;
                         }
 
+                        if (match_offset <= 0
+                            || match_offset > (int)window_size
+                            || window_posn + match_length > window_size)
+                            return -1;
+
                         rundest = (int)window_posn;
                         this_run -= match_length;
 
@@ -370,9 +370,11 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
                 break;
 
             case BLOCKTYPE_UNCOMPRESSED:
-                if (((int)inData.tellg() + this_run) > (int)endpos)
+                if (bitbuf.position + this_run > endpos)
                     return -1;
-                inData.read(window, window_posn);
+                memcpy(&window[window_posn], &inData[bitbuf.position],
+                    this_run);
+                bitbuf.position += this_run;
                 window_posn += (unsigned int)this_run;
                 break;
 
@@ -388,30 +390,17 @@ int LzxDecoder::Decompress(std::stringstream& inData, unsigned int inLen,
     if (start_window_pos == 0)
         start_window_pos = (int)window_size;
     start_window_pos -= outLen;
-    outData.write(&window[start_window_pos], outLen);
+    if (start_window_pos < 0)
+        return -1;
+    memcpy(outData, &window[start_window_pos], outLen);
 
     m_state->window_posn = window_posn;
     m_state->R0 = R0;
     m_state->R1 = R1;
     m_state->R2 = R2;
 
-    if ((m_state->frames_read++ < 32768) && m_state->intel_filesize != 0)
-    {
-        if (outLen <= 6 || !m_state->intel_started)
-            m_state->intel_curpos += outLen;
-        else
-        {
-            int dataend = outLen - 10;
-            unsigned int curpos = (unsigned int)m_state->intel_curpos;
-            
-            m_state->intel_curpos = (int)curpos + outLen;
-            
-            while ((int) outData.tellg() < dataend)
-                if (outData.get() != 0xE8)
-                    curpos++;
-        }
-        return -1;
-    }
+    // XNB files don't use Intel E8 call translation, so there is nothing
+    // left to undo.
     return 0;
 }
 
@@ -491,7 +480,7 @@ int LzxDecoder::MakeDecodeTable(unsigned int nsyms, unsigned int nbits,
     return 0;
 }
 
-void LzxDecoder::ReadLengths(char* lens, unsigned int first,
+int LzxDecoder::ReadLengths(char* lens, unsigned int first,
     unsigned int last, BitBuffer* bitbuf)
 {
     unsigned int x, y;
@@ -502,9 +491,10 @@ void LzxDecoder::ReadLengths(char* lens, unsigned int first,
         y = bitbuf->ReadBits(4);
         m_state->PRETREE_len[x] = (char)y;
     }
-    MakeDecodeTable(PRETREE_MAXSYMBOLS, PRETREE_TABLEBITS,
-                    m_state->PRETREE_len, m_state->PRETREE_table);
-    
+    if (MakeDecodeTable(PRETREE_MAXSYMBOLS, PRETREE_TABLEBITS,
+                        m_state->PRETREE_len, m_state->PRETREE_table))
+        return 1;
+
     for (x = first; x < last;)
     {
         z = (int)ReadHuffSym(m_state->PRETREE_table, m_state->PRETREE_len,
@@ -533,6 +523,7 @@ void LzxDecoder::ReadLengths(char* lens, unsigned int first,
             lens[x++] = (char)z;
         }
     }
+    return 0;
 }
 
 unsigned int LzxDecoder::ReadHuffSym(unsigned short* table, char* lengths,
@@ -557,9 +548,12 @@ unsigned int LzxDecoder::ReadHuffSym(unsigned short* table, char* lengths,
     return i;
 }
 
-BitBuffer::BitBuffer(std::stringstream* stream)
+BitBuffer::BitBuffer(const unsigned char* data, size_t length,
+    size_t position)
 {
-    byteStream = stream;
+    this->data = data;
+    this->length = length;
+    this->position = position;
     InitBitStream();
 }
 
@@ -573,8 +567,8 @@ void BitBuffer::EnsureBits(char bits)
 {
     while (bitsleft < bits)
     {
-        int lo = byteStream->get();
-        int hi = byteStream->get();
+        int lo = ReadByte();
+        int hi = ReadByte();
         int amount2shift = sizeof(unsigned int)*8 - 16 - bitsleft;
         buffer |= (unsigned int)(((hi << 8) | lo) << amount2shift);
         bitsleft += 16;
@@ -606,6 +600,24 @@ unsigned int BitBuffer::ReadBits(char bits)
     return ret;
 }
 
+unsigned int BitBuffer::ReadUInt32()
+{
+    unsigned int b0 = ReadByte(), b1 = ReadByte(), b2 = ReadByte(),
+        b3 = ReadByte();
+    return b0 | b1 << 8 | b2 << 16 | b3 << 24;
+}
+
+int BitBuffer::ReadByte()
+{
+    // Reading past the end yields zeroes; the decoder checks the position.
+    if (position >= length)
+    {
+        position++;
+        return 0;
+    }
+    return data[position++];
+}
+
 unsigned int BitBuffer::GetBuffer()
 {
     return buffer;
@@ -616,41 +628,442 @@ char BitBuffer::GetBitsLeft()
     return bitsleft;
 }
 
-/////////////////////////////////// PYTHON ///////////////////////////////////
+////////////////////////////////// ENCODER ///////////////////////////////////
+BitWriter::BitWriter(std::vector<unsigned char>* out)
+{
+    this->out = out;
+    buffer = 0;
+    bitcount = 0;
+}
 
-// Decodes LZX-compressed XNB data.
-static PyObject* BM_Lzx_Decompress(PyObject* self, PyObject* args)
+// Writes the bits most significant first, in 16-bit little-endian words.
+void BitWriter::WriteBits(unsigned int value, int bits)
 {
-    const char* inObj;
-    unsigned int inLen;
-    unsigned int outLen;
-    std::stringstream inData;
-    std::stringstream outData;
+    buffer = (buffer << bits) | (value & ((1u << bits) - 1));
+    bitcount += bits;
+    while (bitcount >= 16)
+    {
+        bitcount -= 16;
+        unsigned int word = (unsigned int)(buffer >> bitcount) & 0xFFFF;
+        out->push_back((unsigned char)(word & 0xFF));
+        out->push_back((unsigned char)(word >> 8));
+    }
+    buffer &= (1ull << bitcount) - 1;
+}
 
-    if (!PyArg_ParseTuple(args, "ly#", &outLen, &inObj, &inLen))
-        return NULL;
+// Pads the last word with zeroes.
+void BitWriter::Flush()
+{
+    if (bitcount > 0)
+        WriteBits(0, 16 - bitcount);
+}
 
-    inData.write(inObj, inLen);
+LzxEncoder::LzxEncoder()
+{
+    unsigned int i, j;
 
-    LzxDecoder* decoder = new LzxDecoder(16);
-    unsigned int pos = 0;
-    int hi, lo;
+    for (i = 0, j = 0; i <= 50; i += 2)
+    {
+        extra_bits[i] = extra_bits[i + 1] = (char)j;
+        if ((i != 0) && (j < 17)) j++;
+    }
+
+    for (i = 0, j = 0; i <= 50; i++)
+    {
+        position_base[i] = (unsigned int)j;
+        j += 1 << extra_bits[i];
+    }
+}
+
+unsigned int LzxEncoder::Hash(const unsigned char* data)
+{
+    return ((data[0] << 10) ^ (data[1] << 5) ^ data[2])
+        & ((1 << HASH_BITS) - 1);
+}
+
+// Adds a position to the hash chains, if three bytes can be read from it.
+void LzxEncoder::Insert(const unsigned char* data, size_t pos, size_t end)
+{
+    if (pos + 3 > end)
+        return;
+    unsigned int h = Hash(&data[pos]);
+    prev[pos & ((1 << WINDOW_BITS) - 1)] = head[h];
+    head[h] = (int)pos;
+}
+
+// Returns the length of the longest match at pos not going past end, and
+// sets its distance. Repeated distances are tried first, being cheaper.
+unsigned int LzxEncoder::FindMatch(const unsigned char* data, size_t pos,
+    size_t end, unsigned int* distance)
+{
+    unsigned int max_len = (unsigned int)(end - pos), best = 0, len, chain;
+    unsigned int repeats[3] = {R0, R1, R2};
+    const unsigned char* cur = &data[pos];
+    int i, candidate;
+
+    if (max_len > MAX_MATCH)
+        max_len = MAX_MATCH;
+    if (max_len < 3)
+        return 0;
+
+    for (i = 0; i < 3; i++)
+    {
+        if (repeats[i] > pos)
+            continue;
+        const unsigned char* match = cur - repeats[i];
+        for (len = 0; len < max_len && match[len] == cur[len]; len++);
+        if (len > best)
+        {
+            best = len;
+            *distance = repeats[i];
+        }
+    }
+    if (best >= NICE_MATCH)
+        return best;
+
+    candidate = head[Hash(cur)];
+    for (chain = MAX_CHAIN; candidate >= 0 && chain > 0; chain--)
+    {
+        if (pos - candidate > MAX_DISTANCE)
+            break;
+        const unsigned char* match = &data[candidate];
+        if (match[best] == cur[best])
+        {
+            for (len = 0; len < max_len && match[len] == cur[len]; len++);
+            if (len > best)
+            {
+                best = len;
+                *distance = (unsigned int)(pos - candidate);
+                if (len >= NICE_MATCH || len == max_len)
+                    break;
+            }
+        }
+        int next = prev[candidate & ((1 << WINDOW_BITS) - 1)];
+        // The chains are stored in a ring: stop at overwritten entries.
+        if (next >= candidate)
+            break;
+        candidate = next;
+    }
+    return best >= 3 ? best : 0;
+}
+
+// Adds a match token, updating the repeated distances like the decoder.
+void LzxEncoder::AddMatch(unsigned int length, unsigned int distance,
+    std::vector<LzxToken>& tokens)
+{
+    LzxToken token;
+    unsigned int slot, formatted;
+
+    token.verbatim = 0;
+    token.verbatim_bits = 0;
+    if (distance == R0)
+        slot = 0;
+    else if (distance == R1)
+    {
+        slot = 1;
+        R1 = R0; R0 = distance;
+    }
+    else if (distance == R2)
+    {
+        slot = 2;
+        R2 = R0; R0 = distance;
+    }
+    else
+    {
+        formatted = distance + 2;
+        for (slot = 3; position_base[slot + 1] <= formatted; slot++);
+        token.verbatim = formatted - position_base[slot];
+        token.verbatim_bits = extra_bits[slot];
+        R2 = R1; R1 = R0; R0 = distance;
+    }
+
+    length -= MIN_MATCH;
+    if (length < NUM_PRIMARY_LENGTHS)
+    {
+        token.main_element = (unsigned short)(NUM_CHARS + (slot << 3)
+            + length);
+        token.length_footer = 0xFFFF;
+    }
+    else
+    {
+        token.main_element = (unsigned short)(NUM_CHARS + (slot << 3)
+            + NUM_PRIMARY_LENGTHS);
+        token.length_footer = (unsigned short)(length - NUM_PRIMARY_LENGTHS);
+    }
+    tokens.push_back(token);
+}
+
+// Computes Huffman code lengths of at most maxbits bits. The frequencies are
+// halved until the code fits. A single used symbol gets a sibling, as the
+// decoder only accepts complete codes.
+void LzxEncoder::MakeLengths(const unsigned int* freqs, unsigned int nsyms,
+    int maxbits, char* lengths)
+{
+    std::vector<unsigned int> weights(freqs, freqs + nsyms);
+    std::vector<int> parents;
+    unsigned int sym, used = 0, last = 0;
+
+    memset(lengths, 0, nsyms);
+    for (sym = 0; sym < nsyms; sym++)
+        if (weights[sym])
+        {
+            used++;
+            last = sym;
+        }
+    if (used == 0)
+        return;
+    if (used == 1)
+    {
+        lengths[last] = 1;
+        lengths[last == 0 ? 1 : 0] = 1;
+        return;
+    }
+
+    for (;;)
+    {
+        typedef std::pair<unsigned long long, int> Node;
+        std::priority_queue<Node, std::vector<Node>, std::greater<Node> >
+            queue;
+        parents.assign(nsyms, -1);
+        for (sym = 0; sym < nsyms; sym++)
+            if (weights[sym])
+                queue.push(Node(weights[sym], (int)sym));
+        while (queue.size() > 1)
+        {
+            Node a = queue.top(); queue.pop();
+            Node b = queue.top(); queue.pop();
+            int node = (int)parents.size();
+            parents.push_back(-1);
+            parents[a.second] = parents[b.second] = node;
+            queue.push(Node(a.first + b.first, node));
+        }
+
+        int longest = 0;
+        for (sym = 0; sym < nsyms; sym++)
+        {
+            if (!weights[sym])
+                continue;
+            int depth = 0;
+            for (int node = parents[sym]; node >= 0; node = parents[node])
+                depth++;
+            lengths[sym] = (char)(depth > maxbits ? 0 : depth);
+            if (depth > longest)
+                longest = depth;
+        }
+        if (longest <= maxbits)
+            return;
+        for (sym = 0; sym < nsyms; sym++)
+            if (weights[sym])
+                weights[sym] = (weights[sym] >> 1) | 1;
+    }
+}
+
+// Computes the canonical codes of the lengths, as the decoder expects them.
+void LzxEncoder::MakeCodes(const char* lengths, unsigned int nsyms,
+    unsigned short* codes)
+{
+    unsigned int counts[MAX_CODE_LENGTH + 1] = {0};
+    unsigned int next[MAX_CODE_LENGTH + 1];
+    unsigned int sym, bits, code = 0;
+
+    for (sym = 0; sym < nsyms; sym++)
+        counts[(int)lengths[sym]]++;
+    counts[0] = 0;
+    for (bits = 1; bits <= MAX_CODE_LENGTH; bits++)
+    {
+        code = (code + counts[bits - 1]) << 1;
+        next[bits] = code;
+    }
+    for (sym = 0; sym < nsyms; sym++)
+        codes[sym] = lengths[sym] ? (unsigned short)next[(int)lengths[sym]]++
+            : 0;
+}
+
+// Writes the lengths between first and last as deltas from the previous
+// block's, runs of zeroes being shortened, preceded by their pretree.
+void LzxEncoder::WriteLengths(const char* lengths, char* previous,
+    unsigned int first, unsigned int last, BitWriter* bitbuf)
+{
+    std::vector<std::pair<int, int> > symbols;
+    unsigned int freqs[PRETREE_NUM_ELEMENTS] = {0};
+    char pretree_len[PRETREE_NUM_ELEMENTS];
+    unsigned short pretree_codes[PRETREE_NUM_ELEMENTS];
+    unsigned int x, run;
+
+    for (x = first; x < last;)
+    {
+        for (run = 0; x + run < last && lengths[x + run] == 0; run++);
+        if (run >= 20)
+        {
+            if (run > 51) run = 51;
+            symbols.push_back(std::make_pair(18, (int)run - 20));
+            x += run;
+        }
+        else if (run >= 4)
+        {
+            symbols.push_back(std::make_pair(17, (int)run - 4));
+            x += run;
+        }
+        else
+        {
+            int z = previous[x] - lengths[x];
+            if (z < 0) z += 17;
+            symbols.push_back(std::make_pair(z, 0));
+            x++;
+        }
+        freqs[symbols.back().first]++;
+    }
+
+    MakeLengths(freqs, PRETREE_NUM_ELEMENTS, PRETREE_MAX_CODE_LENGTH,
+        pretree_len);
+    MakeCodes(pretree_len, PRETREE_NUM_ELEMENTS, pretree_codes);
+    for (x = 0; x < PRETREE_NUM_ELEMENTS; x++)
+        bitbuf->WriteBits(pretree_len[x], 4);
+    for (x = 0; x < symbols.size(); x++)
+    {
+        int z = symbols[x].first;
+        bitbuf->WriteBits(pretree_codes[z], pretree_len[z]);
+        if (z == 17)
+            bitbuf->WriteBits(symbols[x].second, 4);
+        else if (z == 18)
+            bitbuf->WriteBits(symbols[x].second, 5);
+    }
+    memcpy(&previous[first], &lengths[first], last - first);
+}
+
+// Encodes the data in frames of 32 KB, each made of a single verbatim block
+// and preceded by its size, as XNB files store them.
+// Returns false if a frame doesn't fit in its size field.
+bool LzxEncoder::Compress(const unsigned char* inData, size_t inLen,
+    std::vector<unsigned char>& out)
+{
+    std::vector<LzxToken> tokens;
+    std::vector<unsigned char> block;
+    unsigned int main_freqs[MAIN_ELEMENTS];
+    unsigned int length_freqs[NUM_SECONDARY_LENGTHS];
+    char main_len[MAIN_ELEMENTS];
+    char length_len[NUM_SECONDARY_LENGTHS];
+    unsigned short main_codes[MAIN_ELEMENTS];
+    unsigned short length_codes[NUM_SECONDARY_LENGTHS];
+    size_t start, end, pos, i;
+    unsigned int len, distance, next_len, next_distance;
+
+    R0 = R1 = R2 = 1;
+    memset(MAINTREE_len, 0, sizeof(MAINTREE_len));
+    memset(LENGTH_len, 0, sizeof(LENGTH_len));
+    head.assign(1 << HASH_BITS, -1);
+    prev.assign(1 << WINDOW_BITS, -1);
+    out.clear();
+
+    for (start = 0; start < inLen; start = end)
+    {
+        end = start + FRAME_SIZE < inLen ? start + FRAME_SIZE : inLen;
+
+        // Finds the matches, lazily: a match is dropped for a literal if a
+        // longer one starts at the next byte. Matches stay in their frame.
+        tokens.clear();
+        for (pos = start; pos < end;)
+        {
+            len = FindMatch(inData, pos, end, &distance);
+            Insert(inData, pos, inLen);
+            if (len && len < NICE_MATCH && pos + 1 < end)
+            {
+                next_len = FindMatch(inData, pos + 1, end, &next_distance);
+                if (next_len > len + 1)
+                    len = 0;
+            }
+            if (len)
+            {
+                AddMatch(len, distance, tokens);
+                for (i = 1; i < len; i++)
+                    Insert(inData, pos + i, inLen);
+                pos += len;
+            }
+            else
+            {
+                LzxToken token = {inData[pos], 0xFFFF, 0, 0};
+                tokens.push_back(token);
+                pos++;
+            }
+        }
+
+        memset(main_freqs, 0, sizeof(main_freqs));
+        memset(length_freqs, 0, sizeof(length_freqs));
+        for (i = 0; i < tokens.size(); i++)
+        {
+            main_freqs[tokens[i].main_element]++;
+            if (tokens[i].length_footer != 0xFFFF)
+                length_freqs[tokens[i].length_footer]++;
+        }
+        MakeLengths(main_freqs, MAIN_ELEMENTS, MAX_CODE_LENGTH, main_len);
+        MakeLengths(length_freqs, NUM_SECONDARY_LENGTHS, MAX_CODE_LENGTH,
+            length_len);
+        MakeCodes(main_len, MAIN_ELEMENTS, main_codes);
+        MakeCodes(length_len, NUM_SECONDARY_LENGTHS, length_codes);
+
+        block.clear();
+        BitWriter bitbuf(&block);
+        if (start == 0)
+            bitbuf.WriteBits(0, 1);  // No Intel E8 translation.
+        bitbuf.WriteBits(BLOCKTYPE_VERBATIM, 3);
+        bitbuf.WriteBits((unsigned int)((end - start) >> 8), 16);
+        bitbuf.WriteBits((unsigned int)((end - start) & 0xFF), 8);
+        WriteLengths(main_len, MAINTREE_len, 0, NUM_CHARS, &bitbuf);
+        WriteLengths(main_len, MAINTREE_len, NUM_CHARS, MAIN_ELEMENTS,
+            &bitbuf);
+        WriteLengths(length_len, LENGTH_len, 0, NUM_SECONDARY_LENGTHS,
+            &bitbuf);
+        for (i = 0; i < tokens.size(); i++)
+        {
+            const LzxToken& token = tokens[i];
+            bitbuf.WriteBits(main_codes[token.main_element],
+                main_len[token.main_element]);
+            if (token.length_footer != 0xFFFF)
+                bitbuf.WriteBits(length_codes[token.length_footer],
+                    length_len[token.length_footer]);
+            if (token.verbatim_bits)
+                bitbuf.WriteBits(token.verbatim, token.verbatim_bits);
+        }
+        bitbuf.Flush();
+
+        if (block.size() > 0xFFFF)
+            return false;
+        // A full frame's size is implied, unless its first byte would be
+        // mistaken for the marker of a smaller frame.
+        if (end - start != FRAME_SIZE || (block.size() >> 8) == 0xFF)
+        {
+            out.push_back(0xFF);
+            out.push_back((unsigned char)((end - start) >> 8));
+            out.push_back((unsigned char)((end - start) & 0xFF));
+        }
+        out.push_back((unsigned char)(block.size() >> 8));
+        out.push_back((unsigned char)(block.size() & 0xFF));
+        out.insert(out.end(), block.begin(), block.end());
+    }
+    return true;
+}
+
+/////////////////////////////////// PYTHON ///////////////////////////////////
+
+// Decodes LZX-compressed XNB data, filling the output buffer entirely.
+// Returns false if the data is invalid or too short.
+static bool Decompress(const unsigned char* inData, size_t inLen,
+    unsigned char* outData, size_t outLen)
+{
+    LzxDecoder decoder(16);
+    size_t pos = 0;
+    size_t outPos = 0;
     unsigned int frameSize, blockSize;
-    while (pos < inLen)
+    while (pos + 2 <= inLen && outPos < outLen)
     {
-        inData.seekg(pos);
-        hi = inData.get();
-        lo = inData.get();
-        blockSize = (hi << 8) | lo;
+        blockSize = (inData[pos] << 8) | inData[pos + 1];
         frameSize = 0x8000;
-        if (hi == 0xFF)
+        if (inData[pos] == 0xFF)
         {
-            hi = lo;
-            lo = inData.get();
-            frameSize = (hi << 8) | lo;
-            hi = inData.get();
-            lo = inData.get();
-            blockSize = (hi << 8) | lo;
+            if (pos + 5 > inLen)
+                return false;
+            frameSize = (inData[pos + 1] << 8) | inData[pos + 2];
+            blockSize = (inData[pos + 3] << 8) | inData[pos + 4];
             pos += 5;
         }
         else
@@ -658,20 +1071,124 @@ static PyObject* BM_Lzx_Decompress(PyObject* self, PyObject* args)
 
         if (blockSize == 0 || frameSize == 0)
             break;
+        if (blockSize > inLen - pos || frameSize > outLen - outPos)
+            return false;
 
-        decoder->Decompress(inData, blockSize, outData, frameSize);
+        if (decoder.Decompress(inData, inLen, pos, blockSize,
+            &outData[outPos], frameSize) != 0)
+            return false;
         pos += blockSize;
+        outPos += frameSize;
+    }
+
+    return outPos == outLen;
+}
+
+// Decodes LZX-compressed XNB data to a new bytes object.
+// The compressed data can be any object supporting the buffer protocol.
+static PyObject* BM_Lzx_Decompress(PyObject* self, PyObject* args)
+{
+    Py_buffer inData;
+    unsigned int outLen;
+
+    if (!PyArg_ParseTuple(args, "Iy*", &outLen, &inData))
+        return NULL;
+
+    PyObject* result = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)outLen);
+    if (!result)
+    {
+        PyBuffer_Release(&inData);
+        return NULL;
+    }
+
+    bool success;
+    Py_BEGIN_ALLOW_THREADS
+    success = Decompress((const unsigned char*)inData.buf, inData.len,
+        (unsigned char*)PyBytes_AS_STRING(result), outLen);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&inData);
+    if (!success)
+    {
+        Py_DECREF(result);
+        PyErr_SetString(PyExc_ValueError, "Invalid LZX data.");
+        return NULL;
     }
+    return result;
+}
+
+// Decodes LZX-compressed XNB data into a writable buffer, filling it.
+static PyObject* BM_Lzx_DecompressInto(PyObject* self, PyObject* args)
+{
+    Py_buffer outData;
+    Py_buffer inData;
 
-    char* outString = new char[outLen];
-    outData.read(outString, outLen);
-    return Py_BuildValue("y#", outString, outLen);
+    if (!PyArg_ParseTuple(args, "w*y*", &outData, &inData))
+        return NULL;
+
+    bool success;
+    Py_BEGIN_ALLOW_THREADS
+    success = Decompress((const unsigned char*)inData.buf, inData.len,
+        (unsigned char*)outData.buf, outData.len);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&inData);
+    PyBuffer_Release(&outData);
+    if (!success)
+    {
+        PyErr_SetString(PyExc_ValueError, "Invalid LZX data.");
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+// Encodes data to LZX-compressed XNB data, as a new bytes object.
+static PyObject* BM_Lzx_Compress(PyObject* self, PyObject* args)
+{
+    Py_buffer inData;
+
+    if (!PyArg_ParseTuple(args, "y*", &inData))
+        return NULL;
+
+    std::vector<unsigned char> out;
+    bool success, memory_error = false;
+    Py_BEGIN_ALLOW_THREADS
+    try
+    {
+        LzxEncoder encoder;
+        success = encoder.Compress((const unsigned char*)inData.buf,
+            inData.len, out);
+    }
+    catch (std::bad_alloc&)
+    {
+        success = false;
+        memory_error = true;
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&inData);
+    if (memory_error)
+        return PyErr_NoMemory();
+    if (!success)
+    {
+        PyErr_SetString(PyExc_ValueError, "Data can't be LZX-compressed.");
+        return NULL;
+    }
+    return PyBytes_FromStringAndSize((const char*)out.data(),
+        (Py_ssize_t)out.size());
 }
 
 // LZX module methods.
 static PyMethodDef BM_LzxMethods[] = {
     {"decompress", BM_Lzx_Decompress, METH_VARARGS,
+        "decompress(size, data)\n"
         "Decodes LZX-compressed XNB data."},
+    {"decompress_into", BM_Lzx_DecompressInto, METH_VARARGS,
+        "decompress_into(out, data)\n"
+        "Decodes LZX-compressed XNB data into a writable buffer."},
+    {"compress", BM_Lzx_Compress, METH_VARARGS,
+        "compress(data)\n"
+        "Encodes data to LZX-compressed XNB data."},
 
     {NULL, NULL, 0, NULL}
 };
@@ -680,7 +1197,7 @@ static PyMethodDef BM_LzxMethods[] = {
 static struct PyModuleDef BM_LzxModule = {
    PyModuleDef_HEAD_INIT,
    "bm_lzx",
-   "LZX decompression library for XNB files",
+   "LZX compression library for XNB files",
    -1,
    BM_LzxMethods
 };
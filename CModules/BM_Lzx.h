@@ -1,6 +1,6 @@
 /**
  * BastionMod - Lzx
- * Decodes an XNB file using the LZX compression algorithm.
+ * Decodes and encodes XNB files using the LZX compression algorithm.
  * Based on https://bitbucket.org/alisci01/xnbdecompressor/
  *
  * Copyright © 2003-2004 Stuart Caie
@@ -16,9 +16,14 @@
 #ifndef BM_LZX_H
 #define BM_LZX_H 1
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
-#include <sstream>
+#include <string.h>
+#include <functional>
+#include <queue>
+#include <utility>
+#include <vector>
 
 #define MIN_MATCH (2)
 #define MAX_MATCH (257)
@@ -45,6 +50,19 @@
 
 #define LENTABLE_SAFETY (64)
 
+// XNB files use a 64 KB window, and 32 KB frames.
+#define WINDOW_BITS (16)
+#define FRAME_SIZE (0x8000)
+#define NUM_POSITION_SLOTS (32)
+#define MAIN_ELEMENTS (NUM_CHARS + NUM_POSITION_SLOTS * 8)
+#define MAX_DISTANCE ((1 << WINDOW_BITS) - 3)
+#define MAX_CODE_LENGTH (16)
+#define PRETREE_MAX_CODE_LENGTH (15)
+
+#define HASH_BITS (15)
+#define MAX_CHAIN (64)
+#define NICE_MATCH (64)
+
 struct LzxState {
     unsigned int R0, R1, R2;
     unsigned short main_elements;
@@ -80,14 +98,18 @@ class BitBuffer {
 public:
     unsigned int buffer;
     char bitsleft;
-    std::stringstream* byteStream;
+    const unsigned char* data;
+    size_t length;
+    size_t position;
 
-    BitBuffer(std::stringstream* stream);
+    BitBuffer(const unsigned char* data, size_t length, size_t position);
     void InitBitStream();
     void EnsureBits(char bits);
     unsigned int PeekBits(char bits);
     void RemoveBits(char bits);
     unsigned int ReadBits(char bits);
+    unsigned int ReadUInt32();
+    int ReadByte();
 
     unsigned int GetBuffer();
     char GetBitsLeft();
@@ -96,20 +118,69 @@ public:
 class LzxDecoder {
 public:
     unsigned int position_base[52];
-    char extra_bits[51];
+    char extra_bits[52];
 
     LzxDecoder(int window);
-    int Decompress(std::stringstream& inData, unsigned int inLen,
-        std::stringstream& outData, unsigned int outLen);
+    ~LzxDecoder();
+    int Decompress(const unsigned char* inData, size_t inSize,
+        size_t startpos, unsigned int inLen, unsigned char* outData,
+        unsigned int outLen);
 private:
     LzxState* m_state;
 
     int MakeDecodeTable(unsigned int nsyms, unsigned int nbits,
         char* length, unsigned short* table);
-    void ReadLengths(char* lens, unsigned int first, unsigned int last,
+    int ReadLengths(char* lens, unsigned int first, unsigned int last,
         BitBuffer* bitbuf);
     unsigned int ReadHuffSym(unsigned short* table, char* lengths,
         unsigned int nsyms, unsigned int nbits, BitBuffer* bitbuf);
 };
 
+struct LzxToken {
+    unsigned short main_element;
+    unsigned short length_footer;
+    unsigned int verbatim;
+    char verbatim_bits;
+};
+
+class BitWriter {
+public:
+    std::vector<unsigned char>* out;
+    unsigned long long buffer;
+    int bitcount;
+
+    BitWriter(std::vector<unsigned char>* out);
+    void WriteBits(unsigned int value, int bits);
+    void Flush();
+};
+
+class LzxEncoder {
+public:
+    unsigned int position_base[52];
+    char extra_bits[52];
+
+    LzxEncoder();
+    bool Compress(const unsigned char* inData, size_t inLen,
+        std::vector<unsigned char>& out);
+private:
+    unsigned int R0, R1, R2;
+    char MAINTREE_len[MAIN_ELEMENTS];
+    char LENGTH_len[NUM_SECONDARY_LENGTHS];
+    std::vector<int> head;
+    std::vector<int> prev;
+
+    unsigned int Hash(const unsigned char* data);
+    void Insert(const unsigned char* data, size_t pos, size_t end);
+    unsigned int FindMatch(const unsigned char* data, size_t pos,
+        size_t end, unsigned int* distance);
+    void AddMatch(unsigned int length, unsigned int distance,
+        std::vector<LzxToken>& tokens);
+    static void MakeLengths(const unsigned int* freqs, unsigned int nsyms,
+        int maxbits, char* lengths);
+    static void MakeCodes(const char* lengths, unsigned int nsyms,
+        unsigned short* codes);
+    void WriteLengths(const char* lengths, char* previous,
+        unsigned int first, unsigned int last, BitWriter* bitbuf);
+};
+
 #endif
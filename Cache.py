@@ -0,0 +1,144 @@
+# BastionMod - Cache
+# Keeps decoded textures on disk, so that identical textures are only decoded
+# once.
+#
+# Copyright © 2013 Marc Gagné <gagne.marc@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the terms
+# of the Do What The Fuck You Want To Public License, Version 2, as published
+# by Sam Hocevar. See the COPYING file for more details.
+
+import hashlib
+import os
+import struct
+
+from Common import *
+
+
+class TextureCache:
+    """Content-addressed cache of decoded textures.
+
+    Entries are keyed on a hash of the raw XNB data, and hold the texture's
+    format, dimensions and RGBA pixels. Reading an entry marks it as
+    recently used: trim() removes the least recently used entries once the
+    cache grows over its maximum size, which put() checks as it goes.
+
+    Entries are written atomically, so that several processes can share the
+    cache. Failing to read or write the cache isn't an error: the texture is
+    decoded instead."""
+
+    HEADER = struct.Struct('<4sBII')
+    MAGIC = b'BMTC'
+    DEFAULT_SIZE = 0x40000000  # 1 GiB
+    # Fraction of the maximum size which put() trims the cache down to, so
+    # that it isn't scanned again for each new entry.
+    TRIM_RATIO = 0.9
+
+    def __init__(self, cache_dir, max_size=DEFAULT_SIZE):
+        """Initializes the cache stored in the directory."""
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.size = None  # Total size of the entries, once scanned.
+
+    @staticmethod
+    def get_key(data):
+        """Returns the key of a raw XNB file's data."""
+
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get_path(self, key):
+        """Returns the path of an entry."""
+
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Returns the entry's format, width, height and pixels.
+
+        The pixels are a view of the entry's data, which isn't copied.
+        Returns None if there is no such entry."""
+
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except (OSError, IOError):
+            return None
+        if len(data) < TextureCache.HEADER.size:
+            return None
+        magic, format, width, height = TextureCache.HEADER.unpack_from(data)
+        pixels = memoryview(data)[TextureCache.HEADER.size:]
+        if magic != TextureCache.MAGIC or len(pixels) != 4 * width * height:
+            return None
+        return format, width, height, pixels
+
+    def put(self, key, format, width, height, pixels):
+        """Stores an entry.
+
+        The cache is only scanned by the first entry stored, the size of the
+        next ones being added to its total: it is trimmed once that goes
+        over its maximum size, down to TRIM_RATIO of it. Entries stored by
+        other processes meanwhile are only counted by the next scan."""
+
+        path = self.get_path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(TextureCache.HEADER.pack(TextureCache.MAGIC, format,
+                    width, height))
+                f.write(pixels)
+            os.replace(tmp_path, path)
+        except (OSError, IOError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        if self.size is None:
+            self.size = self.scan()[1]
+        else:
+            self.size += TextureCache.HEADER.size + len(pixels)
+        if self.size > self.max_size:
+            self.trim(int(self.max_size * TextureCache.TRIM_RATIO))
+
+    def trim(self, size=None):
+        """Removes the least recently used entries until the cache fits in
+        the specified size, its maximum size by default.
+
+        The entries being written by other processes are left alone."""
+
+        if size is None:
+            size = self.max_size
+        entries, total = self.scan()
+        entries.sort()
+        for mtime, entry_size, path in entries:
+            if total <= size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= entry_size
+        self.size = total
+
+    def scan(self):
+        """Lists the cache's entries, skipping those being written.
+
+        Returns their modification time, size and path, along with their
+        total size."""
+
+        entries = []
+        total = 0
+        for dir_path, dir_names, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+        return entries, total
@@ -6,10 +6,14 @@
 # of the Do What The Fuck You Want To Public License, Version 2, as published
 # by Sam Hocevar. See the COPYING file for more details.
 
+import os
 import struct
 
 from BastionModule import *
 
+# Linux's ioctl request cloning a file, used by link_file() to make reflinks.
+FICLONE = 0x40049409
+
 def read_7BitEncodedInt(data):
     """Reads a 7BitEncodedInt to a numeric value."""
 
@@ -28,21 +32,129 @@ def read_7BitEncodedInt(data):
 
     return None, None
 
+def write_7BitEncodedInt(value):
+    """Packs a numeric value to a 7BitEncodedInt, as read by
+    read_7BitEncodedInt()."""
+
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
 def read_string(stream, s_len_size=1):
     """Reads a string from a stream the first bytes to know its length."""
 
-    s_len = struct.unpack('<H' if s_len_size is 2 else '<B',
+    s_len = struct.unpack('<H' if s_len_size == 2 else '<B',
         stream.read(s_len_size)
     )[0]
     if s_len:
-        return stream.read(s_len).decode('ascii')
+        return str(stream.read(s_len), 'ascii')
     else:
         return None
 
+def pack_string(s, s_len_size=1):
+    """Packs a string preceded by its length, as read by read_string()."""
+
+    data = s.encode('ascii') if s else b''
+    return struct.pack('<H' if s_len_size == 2 else '<B', len(data)) + data
+
+def parse_size(s):
+    """Parses a size such as '512M' or '8G' to a number of bytes."""
+
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    s = s.strip().upper().rstrip('B')
+    try:
+        if s and s[-1] in units:
+            return int(float(s[:-1]) * units[s[-1]])
+        return int(s)
+    except ValueError:
+        raise ValueError('Invalid size: {}'.format(s))
+
+def copy_range(src, dst, offset, size):
+    """Copies size bytes from offset in the src file to the dst file.
+
+    Both files are binary file objects. The data is copied by the kernel
+    when possible, without going through Python."""
+
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    dst.flush()
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while size:
+                n = os.copy_file_range(src_fd, dst_fd, size, offset)
+                if not n:
+                    raise EOFError
+                offset += n
+                size -= n
+            return
+        except OSError:  # Unsupported by the filesystems, fall back.
+            pass
+    if hasattr(os, 'sendfile'):
+        try:
+            while size:
+                n = os.sendfile(dst_fd, src_fd, offset, size)
+                if not n:
+                    raise EOFError
+                offset += n
+                size -= n
+            return
+        except OSError:
+            pass
+    src.seek(offset)
+    while size:
+        data = src.read(min(size, 0x100000))
+        if not data:
+            raise EOFError
+        dst.write(data)
+        size -= len(data)
+
+def link_file(src_path, dst_path, method='hardlink'):
+    """Makes dst_path refer to the same data as src_path.
+
+    method is either 'hardlink', 'symlink' (relative), 'reflink' (a
+    copy-on-write clone) or 'copy'. If the link can't be made, for instance
+    across filesystems, the file is copied instead. Any existing file at
+    dst_path is replaced."""
+
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+    try:
+        if method == 'hardlink':
+            os.link(src_path, dst_path)
+            return
+        elif method == 'symlink':
+            os.symlink(os.path.relpath(src_path, os.path.dirname(dst_path)),
+                dst_path)
+            return
+    except (OSError, NotImplementedError):
+        pass
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if method == 'reflink':
+            try:
+                import fcntl
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except (ImportError, OSError):
+                pass
+        copy_range(src, dst, 0, os.fstat(src.fileno()).st_size)
+
+def format_error(e):
+    """Formats an error for reporting.
+
+    BastionMod errors are reported by their message, the unexpected ones
+    along with their type."""
+
+    if isinstance(e, BastionModError):
+        return e.msg
+    return '{}: {}'.format(type(e).__name__, e)
+
 def F(b):
     """Formats a binary string to a hexadecimal representation."""
 
-    return "".join([hex(x).upper()[2:].zfill(2) for x in tuple(b)])
+    return bytes(b).hex().upper()
 
 # TODO: Remove this.
 def D(i):
@@ -52,6 +164,106 @@ def D(i):
     return "".join(reversed([s[i:i + 2].zfill(2) for i in range(0, len(s), 2)]))
 
 
+class BufferReader:
+    """Reads a buffer as if it were a binary stream, without copying it.
+
+    Reads return memoryview slices of the buffer."""
+
+    def __init__(self, data):
+        """Wraps the buffer."""
+
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, size=-1):
+        """Reads up to size bytes from the buffer."""
+
+        start = min(self.pos, len(self.data))
+        if size < 0:
+            self.pos = len(self.data)
+        else:
+            self.pos = start + size
+        return self.data[start:self.pos]
+
+    def seek(self, offset, whence=0):
+        """Moves to the specified position in the buffer."""
+
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.data)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        """Returns the current position in the buffer."""
+
+        return self.pos
+
+
+class XMLWriter:
+    """Writes an XML document to a text file incrementally.
+
+    The output is identical to minidom's toprettyxml(encoding='utf-8'), with
+    attributes written in the order they are specified, but elements are
+    written as soon as they are started instead of being kept in memory."""
+
+    def __init__(self, f):
+        """Writes the XML declaration to the file."""
+
+        self.f = f
+        self.tags = []
+        self.empty = False
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+
+    @staticmethod
+    def escape(data):
+        """Escapes text or an attribute's value."""
+
+        return data.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '"', '&quot;').replace('>', '&gt;')
+
+    def write_start(self, tag, attributes):
+        """Writes the beginning of an element's start tag."""
+
+        if self.empty:
+            self.f.write('>\n')
+            self.empty = False
+        self.f.write('{}<{}'.format('\t' * len(self.tags), tag))
+        for name, value in attributes:
+            self.f.write(' {}="{}"'.format(name, XMLWriter.escape(value)))
+
+    def start(self, tag, attributes=()):
+        """Starts an element, which holds the next elements until end() is
+        called.
+
+        attributes is a sequence of (name, value) pairs."""
+
+        self.write_start(tag, attributes)
+        self.tags.append(tag)
+        self.empty = True
+
+    def end(self):
+        """Ends the last element started."""
+
+        tag = self.tags.pop()
+        if self.empty:
+            self.f.write('/>\n')
+            self.empty = False
+        else:
+            self.f.write('{}</{}>\n'.format('\t' * len(self.tags), tag))
+
+    def element(self, tag, attributes=(), text=None):
+        """Writes an element with no children other than its text, if any."""
+
+        if text is None:
+            self.start(tag, attributes)
+            self.end()
+        else:
+            self.write_start(tag, attributes)
+            self.f.write('>{}</{}>\n'.format(XMLWriter.escape(text), tag))
+
+
 class BastionModError(Exception):
     """Default error for BastionMod."""
 
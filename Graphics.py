@@ -6,29 +6,42 @@
 # of the Do What The Fuck You Want To Public License, Version 2, as published
 # by Sam Hocevar. See the COPYING file for more details.
 
+from collections import deque
 from copy import deepcopy
+from fnmatch import fnmatch
 from glob import glob
+from io import BytesIO
+import json
 import math
-from multiprocessing import Process
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+from queue import Empty, Queue
+import signal
 import struct
-import xml.dom.minidom as X
+import threading
+import xml.etree.ElementTree as ET
+import zlib
 
+from Cache import *
 from Common import *
+from Manifest import *
+from Output import *
+from Packer import *
 
-try:
-    from PIL import Image
-except ImportError:
-    print('PIL not found. Make sure the Python Imaging Libary is installed.')
+# PNG compression profile for quick extractions. On typical sprites, RLE at
+# the lowest level is about 3 times faster than PIL's defaults, for files
+# about 7% larger.
+PNG_FAST = {'compress_level': 1, 'compress_type': zlib.Z_RLE}
+# Files up to this size are recompressed by --png-recompress.
+PNG_RECOMPRESS_SIZE = 0x10000
 
-# Import the CModules.
-try:
-    import bm_dxt
-    import bm_lzx
-except ImportError:
-    print('Failed to find CModules. Run \'build_CModules.py build\' first.')
-    import sys
-    sys.exit()
+# PIL's Image module and the CModules, imported by load_dependencies().
+Image = None
+bm_dxt = None
+bm_lzx = None
+DEPENDENCIES = ['PIL.Image', 'bm_dxt', 'bm_lzx']
 
 
 class PKG:
@@ -40,41 +53,138 @@ class PKG:
     TEXTURE = 0xAD
     NEXT = 0xBE
 
-    def __init__(self, file_path, debug=False):
-        """Loads the PKG's data (atlases and XNB textures."""
+    def __init__(self, file_path, debug=False, load=True, cache=None):
+        """Opens the PKG and loads its data (atlases and XNB textures).
 
-        self.name = os.path.splitext(os.path.basename(file_path))[0]
-        if os.path.basename(os.path.dirname(file_path)) == '720p':
-            self.name += '_720p'
+        If load is False, the textures are only decoded while iterating over
+        iter_textures(). If a TextureCache is specified, the textures found
+        in it aren't decoded again."""
+
+        load_dependencies()
+        self.name = PKG.get_name(file_path)
+        self.file_path = file_path
         self.version = 0
         self.debug = debug
+        self.cache = cache
+        self.atlases = []
+        self.loaded = False
 
         print('  {}'.format(self.name))
+        if load:
+            self.atlases = self.load_atlases(PKG.map_file(file_path))
+            self.loaded = True
+
+    @staticmethod
+    def get_name(file_path):
+        """Returns the name of the PKG stored at the specified path."""
+
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        if os.path.basename(os.path.dirname(file_path)) == '720p':
+            name += '_720p'
+        return name
+
+    @staticmethod
+    def map_file(file_path):
+        """Memory-maps a PKG file and returns a reader over its data.
+
+        The reader's reads are slices of the mapping, so the textures' data
+        is never copied. The mapping is released along with its last slice."""
+
         try:
             with open(file_path, 'rb') as f:
-                self.atlases = self.load_atlases(f)
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         except (OSError, IOError):
             raise GraphicsError('Failed to open PKG.')
+        except ValueError:  # Empty file
+            raise GraphicsError('Invalid PKG file.')
+        return BufferReader(data)
+
+    def iter_textures(self, entries=None, decode=True):
+        """Yields the PKG's atlases one at a time, along with their texture.
+
+        Only the texture being yielded is decoded; it can be released with
+        Atlas.release() once it has been used. The atlases themselves are
+        kept in self.atlases.
+
+        If a list of PKGIndex entries is specified, only their textures are
+        read, seeking directly to them. If decode is False, the textures are
+        left in their original format."""
+
+        f = PKG.map_file(self.file_path)
+        if entries is None:
+            atlases = self.read_atlases(f, decode)
+        else:
+            self.version = PKG.read_header(f)
+            atlases = (self.load_texture(PKGIndex.get_atlas(e), e['Texture'],
+                f.data[e['Offset']:e['Offset'] + e['Size']], decode)
+                for e in entries)
+        for atlas, texture in atlases:
+            self.atlases.append(atlas)
+            yield atlas, texture
 
     def load_atlases(self, f):
-        """Loads all the atlases contained within the file."""
+        """Loads all the atlases contained within the file.
 
-        atlases = []
-        current_atlas = None
+        f can be any binary stream, such as a reader from map_file()."""
+
+        return [atlas for atlas, texture in self.read_atlases(f)]
+
+    def read_atlases(self, f, decode=True):
+        """Reads the atlases contained within the file one at a time.
+
+        Yields each atlas once its texture has been loaded and applied."""
+
+        self.version = PKG.read_header(f)
+        for atlas, name, offset, size in PKG.read_assets(f):
+            f.seek(offset)
+            atlas, texture = self.load_texture(atlas, name, f.read(size),
+                decode)
+            yield atlas, texture
+            del atlas, texture
+
+    def load_texture(self, atlas, name, data, decode=True):
+        """Loads a texture and applies it to its atlas.
+
+        If there is no atlas, a virtual one holding a single image covering
+        the whole texture is created."""
+
+        texture = Texture(name, data, self.debug, decode, self.cache)
+        print('    Texture: {}'.format(name))
+
+        if not atlas:
+            atlas = Atlas(True)
+            image = AtlasImage(name, 0, 0, texture.width, texture.height, 0,
+                0, texture.width, texture.height, 1.0, 1.0
+            )
+            atlas.add_image(image)
+        atlas.apply_texture(texture)
+        return atlas, texture
 
-        # Load the header.
-        self.version = struct.unpack('>I', f.read(0x4))[0]
-        if self.version != PKG.VERSION:
+    @staticmethod
+    def read_header(f):
+        """Reads the PKG's header, returning its version."""
+
+        version = struct.unpack('>I', f.read(0x4))[0]
+        if version != PKG.VERSION:
             raise GraphicsError('Invalid PKG file.')
+        return version
+
+    @staticmethod
+    def read_assets(f):
+        """Reads the assets' headers, without loading the textures.
+
+        Yields the atlas (or None), name, offset and size of each texture.
+        The stream may be moved around between iterations."""
 
-        # Load the atlases and textures, and combine them to obtain images.
+        current_atlas = None
+
+        # Load the atlases and the textures' positions.
         while True:
-            asset_type = ord(f.read(1))
+            asset_type = f.read(1)[0]
 
             if asset_type == PKG.ATLAS:  # Atlas definition
                 # Load the atlas' header.
                 current_atlas = Atlas()
-                atlases.append(current_atlas)
                 next_asset, num_images = struct.unpack('>II', f.read(0x8))
 
                 # Load the images' data.
@@ -88,22 +198,10 @@ class PKG:
                 # Load the texture's header.
                 name = read_string(f)
                 size = struct.unpack('>I', f.read(4))[0]
-                texture = Texture(name, f.read(size), self.debug)
-                print('    Texture: {}'.format(name))
-
-                if current_atlas:
-                    current_atlas.apply_texture(texture)
-                    current_atlas = None
-                else:
-                    atlas = Atlas(True)
-                    atlases.append(atlas)
-                    image = AtlasImage(name, 0, 0, texture.width,
-                        texture.height, 0, 0, texture.width, texture.height,
-                        1.0, 1.0
-                    )
-                    atlas.add_image(image)
-                    atlas.apply_texture(texture)
-                    del atlas
+                offset = f.tell()
+                yield current_atlas, name, offset, size
+                current_atlas = None
+                f.seek(offset + size)
 
             elif asset_type == PKG.NEXT:  # Skip to next chunk
                 next_chunk = math.ceil(f.tell() / 0x800000) * 0x800000
@@ -115,62 +213,336 @@ class PKG:
             else:
                 raise GraphicsError('Invalid asset type.')
 
-        return atlases
-
     def save_xml(self, file_path):
         """Saves the PKG's data to an XML file."""
 
-        # Build the XML data.
-        impl = X.getDOMImplementation()
-        doc = impl.createDocument(None, 'PKG', None)
-        root = doc.documentElement
-        root.setAttribute('Name', self.name)
-        root.setAttribute('Version', str(self.version))
-        for a in self.atlases:
-            atlas = doc.createElement('Atlas')
-            atlas.setAttribute('Virtual', str(int(a.virtual)))
-            atlas.setAttribute('Texture', a.texture.name)
-            atlas.setAttribute('Format', str(a.texture.format))
-            atlas.setAttribute('Width', str(a.texture.width))
-            atlas.setAttribute('Height', str(a.texture.height))
-            for i in a.images:
-                image = doc.createElement('Image')
-                image.setAttribute('Name', i.name)
-                image.setAttribute('PosX', str(i.pos[0]))
-                image.setAttribute('PosY', str(i.pos[1]))
-                image.setAttribute('Width', str(i.width))
-                image.setAttribute('Height', str(i.height))
-                image.setAttribute('TopX', str(i.top[0]))
-                image.setAttribute('TopY', str(i.top[1]))
-                image.setAttribute('OriginalSizeX', str(i.original_size[0]))
-                image.setAttribute('OriginalSizeY', str(i.original_size[1]))
-                image.setAttribute('ScaleX', str(i.scale[0]))
-                image.setAttribute('ScaleY', str(i.scale[0]))
-                atlas.appendChild(image)
-            root.appendChild(atlas)
-
-        # Write the XML data.
-        if not os.path.exists(os.path.dirname(file_path)):
-            os.makedirs(os.path.dirname(file_path))
-        xml_data = doc.toprettyxml(encoding='utf-8')
+        # Write the XML data, one atlas at a time.
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
         try:
-            with open(file_path, 'wb') as f:
-                f.write(xml_data)
+            with open(file_path, 'w', encoding='utf-8', newline='') as f:
+                xml = XMLWriter(f)
+                xml.start('PKG', (('Name', self.name),
+                    ('Version', str(self.version))))
+                for a in self.atlases:
+                    attributes = [
+                        ('Virtual', str(int(a.virtual))),
+                        ('Texture', a.texture.name),
+                        ('Format', str(a.texture.format)),
+                        ('Width', str(a.texture.width)),
+                        ('Height', str(a.texture.height))
+                    ]
+                    if a.file:
+                        attributes.append(('File', a.file))
+                    xml.start('Atlas', attributes)
+                    for i in a.images:
+                        xml.element('Image', (
+                            ('Name', i.name),
+                            ('PosX', str(i.pos[0])),
+                            ('PosY', str(i.pos[1])),
+                            ('Width', str(i.width)),
+                            ('Height', str(i.height)),
+                            ('TopX', str(i.top[0])),
+                            ('TopY', str(i.top[1])),
+                            ('OriginalSizeX', str(i.original_size[0])),
+                            ('OriginalSizeY', str(i.original_size[1])),
+                            ('ScaleX', str(i.scale[0])),
+                            ('ScaleY', str(i.scale[1]))
+                        ))
+                    xml.end()
+                xml.end()
         except (OSError, IOError):
             raise GraphicsError('Failed to write XML PKG.')
 
-    def output_graphics(self, output_dir):
-        """Outputs the images contained within to PNG files."""
+    @staticmethod
+    def read_xml(file_path):
+        """Reads the atlases of an XML file written by save_xml(), one at a
+        time.
+
+        Yields each atlas along with its texture's name, format, width and
+        height."""
+
+        try:
+            for event, e in ET.iterparse(file_path):
+                if e.tag != 'Atlas':
+                    continue
+                atlas = Atlas(e.get('Virtual') == '1')
+                atlas.file = e.get('File')
+                for i in e.iter('Image'):
+                    atlas.add_image(AtlasImage(i.get('Name'),
+                        *[int(i.get(k)) for k in ('PosX', 'PosY', 'Width',
+                            'Height', 'TopX', 'TopY', 'OriginalSizeX',
+                            'OriginalSizeY')],
+                        float(i.get('ScaleX')), float(i.get('ScaleY'))
+                    ))
+                yield (atlas, e.get('Texture'), int(e.get('Format')),
+                    int(e.get('Width')), int(e.get('Height')))
+                e.clear()
+        except (OSError, IOError):
+            raise GraphicsError('Failed to read XML PKG.')
+        except (ET.ParseError, TypeError, ValueError):
+            raise GraphicsError('Invalid XML PKG.')
+
+    def output_graphics(self, output_dir, entries=None, only=None,
+        output_format='png', encoders=1, png_options=None, output='dir'):
+        """Outputs the images contained within to PNG files.
+
+        The images are encoded by a pool of encoders threads while the next
+        textures are decoded, see ImageWriter.
+
+        If the PKG wasn't loaded, its textures are streamed: each one is
+        released as soon as its images have been written. If glob patterns
+        are specified, only the matching images are output, and only the
+        textures of the specified PKGIndex entries are read.
+
+        png_options are passed to PIL when saving the PNG files. If the
+        output format is 'dds', each atlas' texture is written as is to a DDS
+        file instead, without being decoded. output is the kind of Output
+        backend storing the files: with an archive, it is written next to
+        the XML file.
+
+        Returns the paths of the files which were written."""
+
+        dds = output_format == 'dds'
+        if self.loaded:
+            atlases = self.atlases
+        else:
+            atlases = (atlas for atlas, texture in
+                self.iter_textures(entries, decode=not dds))
+        files = Output.create(output, output_dir, self.name)
+        try:
+            if dds:
+                for atlas in atlases:
+                    if not only or any(i.matches(only) for i in atlas.images):
+                        atlas.file = '{}.dds'.format(atlas.texture.name)
+                        files.write(atlas.file.replace('\\', '/'),
+                            atlas.texture.get_dds())
+                    if not self.loaded:
+                        atlas.release()
+            else:
+                writer = ImageWriter(files, encoders, png_options=png_options)
+                try:
+                    for atlas in atlases:
+                        writer.add_atlas(atlas, only, release=not self.loaded)
+                finally:
+                    writer.close()
+        except BaseException:
+            files.abort()
+            raise
+        written = files.close()
+        if not only:
+            Output.remove_archives(output_dir, self.name, output)
+            path = '{}.xml'.format(os.path.join(output_dir, self.name))
+            self.save_xml(path)
+            written.append(path)
+        return written
+
+
+class PKGWriter:
+    """Writes a PKG file one texture at a time.
+
+    Each texture is written right after its atlas, both in the same chunk
+    of CHUNK_SIZE bytes when possible: if they don't fit in what remains of
+    the current chunk, it is ended by a NEXT record and padded. The file is
+    written to a temporary file, which replaces the PKG once closed."""
+
+    CHUNK_SIZE = 0x800000
+
+    def __init__(self, file_path):
+        """Opens the PKG and writes its header."""
+
+        self.file_path = file_path
+        self.tmp_path = file_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+            self.f = open(self.tmp_path, 'wb')
+            self.f.write(struct.pack('>I', PKG.VERSION))
+        except (OSError, IOError):
+            raise GraphicsError('Failed to write PKG.')
+        self.pos = 0x4
+
+    @staticmethod
+    def pack_atlas(atlas):
+        """Packs an atlas' record.
+
+        The record's first field is the size of its image entries, which is
+        how far the next asset is."""
+
+        images = b''.join(pack_string(i.name) +
+            struct.pack('>iiiiiiiiff', *i.get_properties()[1:])
+            for i in atlas.images)
+        return struct.pack('>BII', PKG.ATLAS, len(images),
+            len(atlas.images)) + images
+
+    def add_texture(self, atlas, name, data):
+        """Writes an XNB texture, preceded by its atlas unless it's
+        virtual."""
+
+        header = bytes([PKG.TEXTURE]) + pack_string(name) + struct.pack('>I',
+            len(data))
+        if atlas and not atlas.virtual:
+            header = PKGWriter.pack_atlas(atlas) + header
+
+        # Move on to the next chunk, keeping room for the record ending the
+        # current one. Assets larger than a chunk are written as they are.
+        chunk_size = PKGWriter.CHUNK_SIZE
+        chunk_end = (self.pos // chunk_size + 1) * chunk_size
+        if (self.pos % chunk_size and self.pos > 0x4 and
+                self.pos + len(header) + len(data) + 1 > chunk_end):
+            self.write(bytes([PKG.NEXT]) + bytes(chunk_end - self.pos - 1))
+        self.write(header)
+        self.write(data)
+
+    def write(self, data):
+        """Writes data at the end of the PKG."""
+
+        try:
+            self.f.write(data)
+        except (OSError, IOError):
+            raise GraphicsError('Failed to write PKG.')
+        self.pos += len(data)
+
+    def close(self):
+        """Ends the PKG and moves it to its final path."""
+
+        self.write(b'\xFF')
+        self.f.close()
+        try:
+            os.replace(self.tmp_path, self.file_path)
+        except OSError:
+            raise GraphicsError('Failed to write PKG.')
+
+    def abort(self):
+        """Closes and removes the temporary PKG, after an error."""
+
+        self.f.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class PKGIndex:
+    """Table of contents of a PKG file.
+
+    Records the atlases' images along with the position of their textures,
+    so that single textures can be read without going through the PKG."""
+
+    VERSION = 1
 
-        self.save_xml('{}.xml'.format(os.path.join(output_dir, self.name)))
-        for atlas in self.atlases:
-            for image in atlas.images:
-                path = '{}.png'.format(os.path.join(output_dir, image.name))
-                path = path.replace('\\', '/')
-                path_dir = os.path.dirname(path)
-                if not os.path.exists(path_dir):
-                    os.makedirs(path_dir)
-                image.output_png(path)
+    def __init__(self, pkg_path):
+        """Initializes the empty index of the PKG."""
+
+        self.pkg_path = pkg_path
+        try:
+            stat = os.stat(pkg_path)
+        except (OSError, IOError):
+            raise GraphicsError('Failed to open PKG.')
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.entries = []
+
+    @staticmethod
+    def load(pkg_path, index_dir):
+        """Loads the PKG's index from the specified directory.
+
+        The index is rebuilt and saved if it's missing or out of date."""
+
+        index = PKGIndex(pkg_path)
+        index_path = os.path.join(index_dir,
+            '{}.idx'.format(PKG.get_name(pkg_path)))
+        if not index.read(index_path):
+            index.build()
+            index.save(index_path)
+        return index
+
+    def build(self):
+        """Builds the index by scanning the PKG's assets."""
+
+        f = PKG.map_file(self.pkg_path)
+        try:
+            PKG.read_header(f)
+            for atlas, name, offset, size in PKG.read_assets(f):
+                f.seek(offset)
+                header = f.read(min(size, 0x100))
+                self.entries.append({
+                    'Texture': name,
+                    'Offset': offset,
+                    'Size': size,
+                    'Virtual': atlas is None,
+                    'Images': [i.get_properties() for i in atlas.images]
+                        if atlas else [],
+                    'Memory': size + 2 * Texture.estimate_size(header, size)
+                })
+        except (struct.error, IndexError):
+            raise GraphicsError('Invalid PKG file.')
+
+    def read(self, file_path):
+        """Reads a saved index. Returns False if it can't be used."""
+
+        try:
+            with open(file_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, IOError, ValueError):
+            return False
+        if (data.get('Version') != PKGIndex.VERSION or
+                data.get('Size') != self.size or
+                data.get('MTime') != self.mtime):
+            return False
+        self.entries = data['Entries']
+        return True
+
+    def save(self, file_path):
+        """Saves the index to a file."""
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            with open(file_path, 'w') as f:
+                json.dump({
+                    'Version': PKGIndex.VERSION,
+                    'Size': self.size,
+                    'MTime': self.mtime,
+                    'Entries': self.entries
+                }, f)
+        except (OSError, IOError):
+            raise GraphicsError('Failed to write PKG index.')
+
+    def select(self, patterns):
+        """Returns the entries holding images which match the patterns."""
+
+        selected = []
+        for entry in self.entries:
+            if entry['Virtual']:
+                names = [entry['Texture']]
+            else:
+                names = [i[0] for i in entry['Images']]
+            if any(match_name(n, patterns) for n in names):
+                selected.append(entry)
+        return selected
+
+    def estimate_memory(self, entries=None, textures=None):
+        """Estimates the peak memory needed to extract the PKG, in bytes.
+
+        Textures are streamed, so only a few are held at a time, each with
+        its raw data, its decoded pixels, and the images cropped from it:
+        by default, the ones in flight in an ImageWriter along with the one
+        being decoded. All of them are assumed to be the largest."""
+
+        if entries is None:
+            entries = self.entries
+        if textures is None:
+            textures = ImageWriter.MAX_TEXTURES + 1
+        return textures * max([e['Memory'] for e in entries] + [0])
+
+    @staticmethod
+    def get_atlas(entry):
+        """Creates the atlas described by an entry, or None if virtual."""
+
+        if entry['Virtual']:
+            return None
+        atlas = Atlas()
+        for properties in entry['Images']:
+            atlas.add_image(AtlasImage(*properties))
+        return atlas
 
 
 class Atlas:
@@ -181,6 +553,7 @@ class Atlas:
 
         self.images = []
         self.virtual = virtual
+        self.file = None
 
     def add_image(self, image):
         """Adds a new image to the atlas."""
@@ -194,6 +567,94 @@ class Atlas:
         for image in self.images:
             image.apply_texture(texture)
 
+    def release(self):
+        """Releases the decoded pixels, keeping only the atlas' properties."""
+
+        self.texture.release()
+        for image in self.images:
+            image.texture = None
+
+    def get_outputs(self, only=None):
+        """Returns the images to output along with the names of their PNG
+        files.
+
+        If glob patterns are specified, only the matching images are
+        returned."""
+
+        return [(image, '{}.png'.format(image.name).replace('\\', '/'))
+            for image in self.images if not only or image.matches(only)]
+
+    def read_images(self, files):
+        """Reads the atlas' images from their PNG files.
+
+        files is a reader returned by Output.open().
+        Returns the RGBA image of each one."""
+
+        pngs = []
+        for image, name in self.get_outputs():
+            try:
+                pngs.append(Image.open(BytesIO(files.read(name))).convert(
+                    'RGBA'))
+            except OSError:
+                raise GraphicsError('Invalid PNG file: {}.'.format(name))
+        return pngs
+
+    def repack(self, pngs, width, height, full=False):
+        """Fits the images' rectangles to their PNG files, which may have
+        been edited.
+
+        The images whose size changed are trimmed of their transparent
+        borders, and placed in the free space around the other ones, which
+        stay where they are. If full is True, or if they don't fit that way,
+        all the images are trimmed and packed again from scratch, in the
+        smallest texture they fit in. The texture is enlarged as needed, up
+        to MAX_TEXTURE_SIZE.
+
+        Returns the texture's dimensions and the trimmed images."""
+
+        if self.virtual:
+            # The texture is the image itself.
+            image = self.images[0]
+            image.width, image.height = image.original_size = pngs[0].size
+            return image.width, image.height, pngs
+
+        changed = [i for i, (image, png) in enumerate(zip(self.images, pngs))
+            if full or png.size != (image.width, image.height)]
+        if not changed:
+            return width, height, pngs
+        for i in changed:
+            pngs[i] = self.images[i].trim(pngs[i])
+        sizes = [(image.width, image.height) for image in self.images]
+
+        positions = None
+        if not full:
+            fixed = dict((i, image.pos) for i, image in enumerate(self.images)
+                if i not in changed)
+            try:
+                width, height, positions = fit_rects(sizes, width, height,
+                    fixed)
+            except GraphicsError:
+                pass
+        if positions is None:
+            if not full:
+                return self.repack(pngs, width, height, True)
+            width, height = min_texture_size(sizes)
+            width, height, positions = fit_rects(sizes, width, height)
+        for image, pos in zip(self.images, positions):
+            image.pos = tuple(pos)
+        return width, height, pngs
+
+    def compose(self, pngs, width, height):
+        """Stitches the atlas' images back together.
+
+        pngs are the images returned by read_images(), fitting their
+        rectangles. Returns the RGBA pixels of the texture."""
+
+        texture = Image.new('RGBA', (width, height))
+        for image, png in zip(self.images, pngs):
+            texture.paste(png, image.pos)
+        return texture.tobytes()
+
 
 class AtlasImage:
     """An image stored in an atlas."""
@@ -210,23 +671,152 @@ class AtlasImage:
         self.original_size = (o_size_x, o_size_y)
         self.scale = (scale_x, scale_y)
 
-        self.image = None
+        self.texture = None
+
+    def get_properties(self):
+        """Returns the image's properties, as passed to the constructor."""
+
+        return [self.name, self.pos[0], self.pos[1], self.width, self.height,
+            self.top[0], self.top[1], self.original_size[0],
+            self.original_size[1], self.scale[0], self.scale[1]]
+
+    def matches(self, patterns):
+        """Checks whether the image's name matches any of the patterns."""
+
+        return match_name(self.name, patterns)
+
+    def trim(self, png):
+        """Fits the image's rectangle to its PNG file, trimmed of its
+        transparent borders.
+
+        The original size is enlarged if the image no longer fits in it.
+        Returns the trimmed image."""
+
+        box = png.getchannel('A').getbbox() or (0, 0) + png.size
+        if box != (0, 0) + png.size:
+            png = png.crop(box)
+        self.width, self.height = png.size
+        self.top = (self.top[0] + box[0], self.top[1] + box[1])
+        self.original_size = (
+            max(self.original_size[0], self.top[0] + self.width),
+            max(self.original_size[1], self.top[1] + self.height)
+        )
+        return png
 
     def apply_texture(self, texture):
-        """Applies the texture to this image, slicing it appropriately."""
+        """Applies the texture to this image.
+
+        Only a reference to the texture is kept: the image's pixels are
+        sliced from it when needed."""
+
+        self.texture = texture
 
-        if texture.image:
-            self.image = texture.image.crop((
-                self.pos[0], self.pos[1],
-                self.pos[0] + self.width, self.pos[1] + self.height
-            ))
+    def get_image(self):
+        """Returns the image's pixels, sliced from its texture.
 
-    def output_png(self, file_path):
-        """Outputs the image as a PNG file."""
+        Returns None if the texture isn't decoded."""
 
-        if not self.image:
+        if not self.texture or not self.texture.image:
+            return None
+        if (self.pos == (0, 0) and self.width == self.texture.width and
+                self.height == self.texture.height):
+            return self.texture.image
+        return self.texture.image.crop((
+            self.pos[0], self.pos[1],
+            self.pos[0] + self.width, self.pos[1] + self.height
+        ))
+
+    def encode_png(self, options=None):
+        """Encodes the image to PNG data.
+
+        Returns None if there's nothing to encode."""
+
+        image = self.get_image()
+        if not image:
+            return None
+        data = BytesIO()
+        image.save(data, format='PNG', **(options or {}))
+        return data.getvalue()
+
+
+class ImageWriter:
+    """Outputs atlas images to PNG files in the background.
+
+    Images are encoded by a pool of threads, then written by a single writer
+    thread, so that encoding overlaps with the decoding of the next textures
+    (PIL releases the GIL while compressing). Only a few textures can be in
+    flight at once: add_atlas() blocks until one is done."""
+
+    MAX_TEXTURES = 2
+
+    def __init__(self, files, encoders=1, max_textures=MAX_TEXTURES,
+        png_options=None):
+        """Starts the encoder and writer threads.
+
+        files is the Output backend storing the files."""
+
+        self.files = files
+        self.png_options = png_options
+        self.encoders = ThreadPool(max(encoders, 1))
+        self.writer = ThreadPool(1)
+        self.slots = threading.BoundedSemaphore(max_textures)
+        self.lock = threading.Lock()
+        self.errors = []
+
+    def add_atlas(self, atlas, only=None, release=False):
+        """Queues the atlas' images to be output.
+
+        If glob patterns are specified, only the matching images are output.
+        If release is True, the texture is released once the last image has
+        been written."""
+
+        self.slots.acquire()
+        outputs = atlas.get_outputs(only)
+        if not outputs:
+            self.done_atlas(atlas, release)
             return
-        self.image.save(file_path, format='PNG')
+        remaining = [len(outputs)]
+
+        def done(error=None):
+            with self.lock:
+                if error:
+                    self.errors.append(error)
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                self.done_atlas(atlas, release)
+
+        def write(data, name):
+            if data is None:
+                done()
+            else:
+                self.writer.apply_async(self.files.write, (name, data),
+                    callback=lambda r: done(),
+                    error_callback=lambda e: done(e))
+
+        for image, name in outputs:
+            self.encoders.apply_async(image.encode_png, (self.png_options,),
+                callback=lambda data, n=name: write(data, n),
+                error_callback=lambda e: done(e))
+
+    def done_atlas(self, atlas, release):
+        """Frees an atlas' slot once all its images are done."""
+
+        if release:
+            atlas.release()
+        self.slots.release()
+
+    def close(self):
+        """Waits for all the images to be output.
+
+        Raises the first error encountered, if any."""
+
+        self.encoders.close()
+        self.encoders.join()
+        self.writer.close()
+        self.writer.join()
+        if self.errors:
+            raise self.errors[0]
 
 
 class Texture:
@@ -241,11 +831,38 @@ class Texture:
     FORMAT_DXT1 = 0x1C
     FORMAT_DXT5 = 0x20
 
-    def __init__(self, name, data, debug):
-        """Loads and eventually decompresses the texture data."""
+    # DXT compression quality: libsquish's range fit, cluster fit and
+    # iterative cluster fit.
+    QUALITY_FAST = 0
+    QUALITY_NORMAL = 1
+    QUALITY_BEST = 2
+
+    DDS_HEADER = struct.Struct('<4sIIIIIII44xII4sIIIIII16x')
+    DDS_FLAGS = 0x1 | 0x2 | 0x4 | 0x1000  # Caps, height, width, pixel format
+    DDS_FOURCC = {FORMAT_DXT1: b'DXT1', FORMAT_DXT5: b'DXT5'}
+
+    def __init__(self, name, data, debug, decode=True, cache=None):
+        """Loads and eventually decompresses the texture data.
+
+        If decode is False, the texture is left in its original format until
+        decode() is called. If a TextureCache is specified, the decoded
+        texture is read from it when possible, and stored in it otherwise."""
 
         self.name = name
         self.debug = debug
+        self.cache = cache
+        self.key = None
+
+        # Use the cached texture, skipping decompression and decoding.
+        if cache and decode:
+            self.key = TextureCache.get_key(data)
+            cached = cache.get(self.key)
+            if cached:
+                self.format, self.width, self.height, pixels = cached
+                self.data = None
+                self.image = Image.frombuffer('RGBA',
+                    (self.width, self.height), pixels, 'raw', 'RGBA', 0, 1)
+                return
 
         # Make sure the XNB file is valid.
         if data[:4] != Texture.HEADER_START:
@@ -257,15 +874,134 @@ class Texture:
         # Check its compression status.
         if self.flags == Texture.COMPRESSED_FLAG:
             d_size = struct.unpack('<I', data[0xA:0xE])[0]
-            texture_data = bm_lzx.decompress(d_size, data[0xE:])
+            try:
+                texture_data = bm_lzx.decompress(d_size, data[0xE:])
+            except ValueError:
+                raise GraphicsError('Failed to decompress XNB file.')
         else:
             texture_data = data[0xA:]
 
-        self.format, self.width, self.height, self.image = (
-            self.get_texture_data(texture_data))
+        # Slice the mip data without copying it, even out of the
+        # decompressed data.
+        self.format, self.width, self.height, i, mip_size = (
+            Texture.read_header(texture_data))
+        self.data = memoryview(texture_data)[i:i + mip_size]
+        self.image = None
+        if decode:
+            self.decode()
+
+    def decode(self):
+        """Decodes the texture's data to an RGBA image."""
+
+        pixels = self.to_rgba(self.format, self.width, self.height, self.data)
+        self.image = Image.frombuffer('RGBA', (self.width, self.height),
+            pixels, 'raw', 'RGBA', 0, 1
+        )
+        if self.key:
+            self.cache.put(self.key, self.format, self.width, self.height,
+                pixels)
+
+    def release(self):
+        """Releases the texture's data and decoded pixels."""
 
-    def get_texture_data(self, texture_data):
-        """Extracts the texture's data from the raw data."""
+        self.data = None
+        self.image = None
+
+    def get_dds(self):
+        """Returns the texture's data, as is, as a DDS file."""
+
+        if self.format in Texture.DDS_FOURCC:
+            header = Texture.DDS_HEADER.pack(b'DDS ', 124,
+                Texture.DDS_FLAGS | 0x80000, self.height, self.width,
+                len(self.data), 0, 1,
+                32, 0x4, Texture.DDS_FOURCC[self.format], 0, 0, 0, 0, 0,
+                0x1000
+            )
+        elif self.format == Texture.FORMAT_COLOR:
+            # Uncompressed BGRA data.
+            header = Texture.DDS_HEADER.pack(b'DDS ', 124,
+                Texture.DDS_FLAGS | 0x8, self.height, self.width,
+                4 * self.width, 0, 1,
+                32, 0x1 | 0x40, bytes(4), 32, 0xFF0000, 0xFF00, 0xFF,
+                0xFF000000, 0x1000
+            )
+        else:
+            raise GraphicsError('Unsupported texture format.')
+        return header + self.data
+
+    @staticmethod
+    def read_dds(data, format, width, height):
+        """Reads the mip data of a DDS file written by get_dds().
+
+        The file must hold a texture of the specified format and dimensions.
+        Only the first mip level is read."""
+
+        if len(data) < Texture.DDS_HEADER.size:
+            raise GraphicsError('Invalid DDS file.')
+        (magic, header_size, flags, dds_height, dds_width, pitch, depth,
+            mip_count, pf_size, pf_flags, fourcc, bit_count, r_mask, g_mask,
+            b_mask, a_mask, caps) = Texture.DDS_HEADER.unpack_from(data)
+        if magic != b'DDS ' or header_size != 124:
+            raise GraphicsError('Invalid DDS file.')
+        if (dds_width, dds_height) != (width, height):
+            raise GraphicsError('DDS file should be {}x{}.'.format(width,
+                height))
+
+        if format in Texture.DDS_FOURCC:
+            valid = pf_flags & 0x4 and fourcc == Texture.DDS_FOURCC[format]
+            block_size = 8 if format == Texture.FORMAT_DXT1 else 16
+            size = ((width + 3) // 4) * ((height + 3) // 4) * block_size
+        elif format == Texture.FORMAT_COLOR:
+            valid = (pf_flags & 0x40 and bit_count == 32 and
+                (r_mask, g_mask, b_mask) == (0xFF0000, 0xFF00, 0xFF))
+            size = 4 * width * height
+        else:
+            raise GraphicsError('Unsupported texture format.')
+        if not valid:
+            raise GraphicsError('DDS file isn\'t in the texture\'s format.')
+
+        start = 4 + header_size
+        if len(data) < start + size:
+            raise GraphicsError('Invalid DDS file.')
+        return data[start:start + size]
+
+    @staticmethod
+    def build_xnb(format, width, height, data, compress=True):
+        """Builds an XNB file holding the texture's mip data, as read by the
+        constructor.
+
+        If compress is True, the file is LZX-compressed, unless that doesn't
+        make it any smaller."""
+
+        texture_data = b''.join((
+            write_7BitEncodedInt(1),  # A single reader, for the Texture2D
+            write_7BitEncodedInt(len(Texture.READER_NAME)),
+            Texture.READER_NAME,
+            bytes(4),  # Reader version
+            write_7BitEncodedInt(0),  # Shared resources
+            write_7BitEncodedInt(1),  # Type id: the first reader
+            struct.pack('<iIIII', format, width, height, 1, len(data)),
+            data
+        ))
+        flags = 0
+        if compress:
+            try:
+                compressed = bm_lzx.compress(texture_data)
+            except (ValueError, MemoryError):
+                raise GraphicsError('Failed to compress XNB file.')
+            if len(compressed) + 0x4 < len(texture_data):
+                flags = Texture.COMPRESSED_FLAG
+                texture_data = struct.pack('<I', len(texture_data)) + (
+                    compressed)
+        return Texture.HEADER_START + struct.pack('<BBI', Texture.VERSION,
+            flags, 0xA + len(texture_data)) + texture_data
+
+    @staticmethod
+    def read_header(texture_data):
+        """Reads the texture's properties from the decompressed XNB data.
+
+        Returns the format, the dimensions, and the offset and size of the
+        texture's mip data."""
 
         # Get the reader information. There should be only a Texture2D reader.
         reader_count, offset = read_7BitEncodedInt(texture_data[0:5])
@@ -294,29 +1030,82 @@ class Texture:
         )
         if mip_count != 1:
             raise GraphicsError('Mip count is not 0.')
-            return None
         i += 16
         mip_size = struct.unpack('<I', texture_data[i:i + 4])[0]
         i += 4
-        image = Image.frombuffer('RGBA', (width, height),
-            self.to_rgba(format, width, height, texture_data[i:i + mip_size]),
-            'raw', 'RGBA', 0, 1
-        )
 
-        return format, width, height, image
+        return format, width, height, i, mip_size
+
+    @staticmethod
+    def estimate_size(data, size):
+        """Estimates the size of a texture once decoded to RGBA.
+
+        Only the start of the XNB data is needed. The dimensions of
+        compressed textures can't be read without decompressing them, so the
+        worst compression ratio (DXT1) is assumed for those."""
+
+        if data[:4] != Texture.HEADER_START:
+            raise GraphicsError('Invalid XNB file.')
+        flags = data[0x5]
+        if flags == Texture.COMPRESSED_FLAG:
+            return 8 * struct.unpack('<I', data[0xA:0xE])[0]
+        format, width, height, i, mip_size = Texture.read_header(data[0xA:])
+        return 4 * width * height
 
     def to_rgba(self, format, width, height, data):
         """Converts data from the specified format to the RGBA format."""
 
         if format == Texture.FORMAT_COLOR:
-            image = []
-            for i in range(0, len(data), 4):
-                image += (data[i+2], data[i+1], data[i], data[i+3])
-            image = bytearray(image)
+            # Swap the blue and red channels of the BGRA data in bulk.
+            image = bytearray(data)
+            image[0::4], image[2::4] = image[2::4], image[0::4]
         elif format == Texture.FORMAT_DXT1:
             image = bm_dxt.to_rgba(1, width, height, data)
         elif format == Texture.FORMAT_DXT5:
             image = bm_dxt.to_rgba(4, width, height, data)
+        else:
+            raise GraphicsError('Unsupported texture format.')
+        return image
+
+    @staticmethod
+    def from_rgba(format, width, height, data, quality=QUALITY_NORMAL,
+        jobs=1):
+        """Converts RGBA data to the specified format.
+
+        quality is one of the QUALITY constants. DXT images are split into
+        horizontal bands, encoded by up to jobs threads."""
+
+        if format == Texture.FORMAT_COLOR:
+            image = bytearray(data)
+            image[0::4], image[2::4] = image[2::4], image[0::4]
+            return image
+        elif format == Texture.FORMAT_DXT1:
+            version, block_size = 1, 8
+        elif format == Texture.FORMAT_DXT5:
+            version, block_size = 4, 16
+        else:
+            raise GraphicsError('Unsupported texture format.')
+
+        # Split the image into bands of whole block rows, several per thread
+        # so that they finish at about the same time.
+        block_rows = (height + 3) // 4
+        row_size = (width + 3) // 4 * block_size
+        if jobs <= 1 or block_rows < 2:
+            return bm_dxt.from_rgba(version, width, height, data,
+                quality=quality)
+        band_rows = max(1, -(-block_rows // (4 * jobs)))
+        image = bytearray(block_rows * row_size)
+        data = memoryview(data)
+        out = memoryview(image)
+        bands = []
+        for row in range(0, block_rows, band_rows):
+            y = 4 * row
+            band_height = min(4 * band_rows, height - y)
+            bands.append((version, width, band_height,
+                data[4 * width * y:4 * width * (y + band_height)],
+                out[row * row_size:(row + band_rows) * row_size], quality))
+        with ThreadPool(min(jobs, len(bands))) as pool:
+            pool.starmap(bm_dxt.from_rgba, bands)
         return image
 
 
@@ -328,6 +1117,58 @@ class Graphics(BastionModule):
     CONTENT_DIR = ''
     EXTRACT_DIR = 'Graphics'
 
+    DXT_QUALITIES = {
+        'fast': Texture.QUALITY_FAST,
+        'normal': Texture.QUALITY_NORMAL,
+        'best': Texture.QUALITY_BEST
+    }
+
+    def __init__(self, debug=False, max_memory=None, only=None,
+        output_format='png', png_level=None, png_fast=False,
+        png_recompress=False, output='dir', cache=None,
+        cache_size=TextureCache.DEFAULT_SIZE, dxt_quality='normal', lzx=True,
+        repack=False, **options):
+        """Initializes the module.
+
+        max_memory is the memory budget shared by the extraction processes,
+        in bytes: it doesn't apply to compilations. only is a list of glob
+        patterns: if specified, only the images whose names match are
+        extracted. output_format is either 'png', to output each image to a
+        PNG file, or 'dds', to output each texture as is to a DDS file.
+
+        png_level is the zlib compression level of the PNG files (0-9), and
+        png_fast selects the PNG_FAST profile. If png_recompress is True,
+        the small PNG files are recompressed as tightly as possible once
+        written, see recompress_png(). output is the kind of Output backend
+        storing each PKG's files.
+
+        cache is the directory of the TextureCache shared by the extractions,
+        which is kept under cache_size bytes.
+
+        When compiling, dxt_quality is the quality of the DXT compression
+        (see DXT_QUALITIES), and lzx tells whether the XNB textures are
+        LZX-compressed. If repack is True, all the atlases are packed again
+        from scratch, see Atlas.repack()."""
+
+        super().__init__(debug, **options)
+        load_dependencies()
+        self.max_memory = max_memory
+        self.only = only
+        self.output_format = output_format
+        self.png_options = dict(PNG_FAST) if png_fast else {}
+        if png_level is not None:
+            self.png_options['compress_level'] = png_level
+        self.png_recompress = png_recompress
+        self.output = output
+        self.cache = cache
+        self.cache_size = cache_size
+        self.dxt_quality = Graphics.DXT_QUALITIES[dxt_quality]
+        self.lzx = lzx
+        self.repack = repack
+
+        # Share the CPUs between the PNG encoders of each process.
+        self.encoders = max(1, (os.cpu_count() or 1) // self.jobs)
+
     def extract(self, graphics_dir, extract_dir):
         """Extracts the graphics data."""
 
@@ -335,24 +1176,346 @@ class Graphics(BastionModule):
         pkgs = sorted(glob(os.path.join(graphics_dir, '*.pkg')))
         if not pkgs:
             raise GraphicsError('Failed to find any PKGs.')
+        if self.only and self.output != 'dir':
+            raise GraphicsError('Partial extractions require the dir output.')
+        if self.png_recompress and self.output != 'dir':
+            raise GraphicsError('PNG recompression requires the dir output.')
+
+        # Skip the PKGs which haven't changed since they were last extracted.
+        # Partial extractions aren't recorded in the manifest.
+        manifest = None
+        if not self.only:
+            manifest = Manifest(extract_dir, self.force)
+
+        # Index the PKGs, to select the textures to extract and estimate how
+        # much memory each PKG needs. The largest ones are started first so
+        # that the longest jobs don't end up running last.
+        errors = []
+        estimates = {}
+        selections = {}
+        unchanged = 0
+        for pkg_path in pkgs:
+            if manifest and manifest.is_fresh(
+                    os.path.relpath(pkg_path, graphics_dir), [pkg_path],
+                    self.manifest_options()):
+                unchanged += 1
+                continue
+            try:
+                index = PKGIndex.load(pkg_path, extract_dir)
+            except Exception as e:
+                errors.append('{}: {}'.format(os.path.basename(pkg_path),
+                    format_error(e)))
+                continue
+            entries = None
+            if self.only:
+                entries = index.select(self.only)
+                if not entries:
+                    continue
+            selections[pkg_path] = entries
+            estimates[pkg_path] = index.estimate_memory(entries,
+                1 if self.output_format == 'dds' else None)
+        if self.only and not estimates and not errors:
+            raise GraphicsError('No images match {}.'.format(
+                ', '.join(self.only)))
+        if unchanged:
+            print('  Skipping {} unchanged PKG(s).'.format(unchanged))
+        pending = sorted(estimates, key=lambda p: estimates[p], reverse=True)
+        for pkg_path in pending:
+            if self.max_memory and estimates[pkg_path] > self.max_memory:
+                print('Warning: {} may exceed the memory budget.'.format(
+                    os.path.basename(pkg_path)))
 
         # Load and process the PKG files.
-        # Use processes to reduce memory usage.
-        for pkg_path in pkgs:
-            p = Process(
-                target=run_process,
-                args=(pkg_path, self.debug, extract_dir)
-            )
-            p.start()
-            p.join()
+        # Use processes to reduce memory usage: each worker only handles a
+        # single PKG before being replaced by a fresh one.
+        running = {}
+        finished = Queue()
+        pool = get_context().Pool(self.jobs, init_process,
+            maxtasksperchild=1)
+        try:
+            while pending or running:
+
+                # Admit as many PKGs as the job count and memory budget allow.
+                # A PKG is always admitted when nothing else is running, even
+                # if it exceeds the budget by itself.
+                for pkg_path in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    used = sum(running.values())
+                    if (running and self.max_memory and
+                            used + estimates[pkg_path] > self.max_memory):
+                        continue
+                    pending.remove(pkg_path)
+                    running[pkg_path] = estimates[pkg_path]
+                    pool.apply_async(
+                        run_process,
+                        (pkg_path, self.debug, extract_dir,
+                            selections[pkg_path], self.only,
+                            self.output_format, self.encoders,
+                            self.png_options, self.png_recompress,
+                            self.output, self.cache, self.cache_size),
+                        callback=lambda r, p=pkg_path: finished.put(
+                            (p, r, None)),
+                        error_callback=lambda e, p=pkg_path: finished.put(
+                            (p, None, e))
+                    )
 
-def run_process(pkg_path, debug, extract_dir):
-    """Runs a package extraction process."""
+                # Wait for a PKG to be done. A worker's error, even an
+                # unexpected one from a corrupt PKG, only fails its own PKG.
+                pkg_path, outputs, e = self.wait(finished.get)
+                del running[pkg_path]
+                if e is not None:
+                    errors.append('{}: {}'.format(
+                        os.path.basename(pkg_path), format_error(e)))
+                elif manifest:
+                    self.update_manifest(manifest,
+                        os.path.relpath(pkg_path, graphics_dir), pkg_path,
+                        outputs)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            if manifest:
+                manifest.save()
+            if self.cache:
+                TextureCache(self.cache, self.cache_size).trim()
+
+        if errors:
+            raise GraphicsError('Failed to extract {} PKG(s).\n  {}'.format(
+                len(errors), '\n  '.join(errors)))
+
+    def compile(self, extract_dir, graphics_dir):
+        """Compiles the graphics data."""
+
+        # Get a list of XML PKGs.
+        xml_paths = sorted(glob(os.path.join(extract_dir, '*.xml')))
+        if not xml_paths:
+            raise GraphicsError('Failed to find any XML PKGs.')
+
+        # The PKGs are compiled one after the other, each one's textures
+        # being encoded by a pool shared between them. When a PKG fails, the
+        # pool is replaced, cancelling the textures still being encoded.
+        errors = []
+        pool = get_context().Pool(self.jobs, init_process)
+        try:
+            for xml_path in xml_paths:
+                try:
+                    self.compile_pkg(pool, xml_path, extract_dir,
+                        graphics_dir)
+                except Exception as e:
+                    errors.append('{}: {}'.format(
+                        os.path.basename(xml_path), format_error(e)))
+                    pool.terminate()
+                    pool.join()
+                    pool = get_context().Pool(self.jobs, init_process)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        if errors:
+            raise GraphicsError('Failed to compile {} PKG(s).\n  {}'.format(
+                len(errors), '\n  '.join(errors)))
+
+    def compile_pkg(self, pool, xml_path, extract_dir, graphics_dir):
+        """Compiles a PKG from its XML file and extracted images.
+
+        The textures are encoded by the pool, a few more than it has
+        processes at a time, and written in the XML file's order as soon as
+        they are done: the PKG doesn't depend on the job count. Atlases are
+        written as the workers return them, repacked if needed."""
+
+        name = os.path.splitext(os.path.basename(xml_path))[0]
+        if name.endswith('_720p'):
+            pkg_path = os.path.join(graphics_dir, '720p', name[:-5] + '.pkg')
+        else:
+            pkg_path = os.path.join(graphics_dir, name + '.pkg')
+        print('  {}'.format(name))
+
+        writer = PKGWriter(pkg_path)
+        pending = deque()
+
+        def write_done(max_pending):
+            while len(pending) > max_pending:
+                texture_name, result = pending.popleft()
+                atlas, data = self.wait(result.get)
+                writer.add_texture(atlas, texture_name, data)
+                print('    Texture: {}'.format(texture_name))
 
+        try:
+            for atlas, texture_name, format, width, height in (
+                    PKG.read_xml(xml_path)):
+                pending.append((texture_name, pool.apply_async(
+                    compile_texture,
+                    (extract_dir, name, atlas, format, width, height,
+                        self.dxt_quality, self.lzx, self.encoders,
+                        self.repack)
+                )))
+                write_done(2 * self.jobs)
+            write_done(0)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+    def wait(self, get, interval=0.1):
+        """Waits for a result, checking whether the module must stop
+        meanwhile.
+
+        get is a blocking getter accepting a timeout, such as Queue.get()
+        or AsyncResult.get(). Returns the result."""
+
+        while True:
+            self.check_stop()
+            try:
+                return get(timeout=interval)
+            except (Empty, multiprocessing.TimeoutError):
+                pass
+
+    def manifest_options(self):
+        """Returns the options recorded with each PKG in the manifest.
+
+        The output format and backend are recorded, so that switching them
+        extracts the PKGs again, replacing the files of the previous ones."""
+
+        return {'Format': self.output_format, 'Output': self.output}
+
+    def update_manifest(self, manifest, key, pkg_path, outputs):
+        """Records an extracted PKG in the manifest.
+
+        The entries of older versions, which recorded each output format
+        and backend under its own key, are removed along with their
+        files."""
+
+        manifest.update(key, [pkg_path], outputs, self.manifest_options())
+        for old_key in list(manifest.entries):
+            if old_key.startswith(key + ':'):
+                manifest.remove(old_key)
+
+def load_dependencies():
+    """Imports PIL and the CModules, unless they already are.
+
+    They are only needed to extract or compile the graphics: importing the
+    module alone doesn't pay for them. Raises GraphicsError if any of them
+    is missing."""
+
+    global Image, bm_dxt, bm_lzx
+    if bm_lzx:
+        return
     try:
-        pkg = PKG(pkg_path, debug)
-        pkg.output_graphics(extract_dir)
-    except KeyboardInterrupt:
-        pass
+        from PIL import Image
+    except ImportError:
+        raise GraphicsError('PIL not found. Make sure the Python Imaging '
+            'Library is installed.')
+    try:
+        import bm_dxt
+        import bm_lzx
+    except ImportError:
+        raise GraphicsError('Failed to find CModules. Run '
+            '\'build_CModules.py build\' first.')
+
+def get_context():
+    """Returns the multiprocessing context of the worker processes.
+
+    Where it's available, the workers are forked from a server process
+    which has already imported this module and its dependencies, so that
+    each PKG's fresh worker is ready at once. Forking them from the main
+    process instead isn't safe while the other modules' threads run."""
+
+    try:
+        context = multiprocessing.get_context('forkserver')
+    except ValueError:
+        return multiprocessing.get_context()
+    context.set_forkserver_preload([__name__] + DEPENDENCIES)
+    return context
+
+def init_process():
+    """Initializes a package extraction process."""
+
+    # Interruptions are handled by the parent process, which terminates the
+    # workers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_process(pkg_path, debug, extract_dir, entries=None, only=None,
+    output_format='png', encoders=1, png_options=None, png_recompress=False,
+    output='dir', cache=None, cache_size=TextureCache.DEFAULT_SIZE):
+    """Runs a package extraction process."""
 
-MODULES.append(Graphics)
+    if cache:
+        cache = TextureCache(cache, cache_size)
+    pkg = PKG(pkg_path, debug, load=False, cache=cache)
+    written = pkg.output_graphics(extract_dir, entries, only, output_format,
+        encoders, png_options, output)
+    if png_recompress:
+        pngs = [p for p in written if p.endswith('.png')]
+        with ThreadPool(encoders) as pool:
+            pool.map(recompress_png, pngs)
+    return written
+
+def compile_texture(extract_dir, pkg_name, atlas, format, width, height,
+    quality=Texture.QUALITY_NORMAL, compress=True, encoders=1, repack=False):
+    """Builds the XNB file of an atlas' texture from the extracted files.
+
+    The texture is either read as is from the atlas' DDS file, or stitched
+    back together from its images and encoded to its format by up to
+    encoders threads. In the latter case, the atlas is repacked if its
+    images changed size, or from scratch if repack is True.
+
+    Returns the atlas, whose images may have moved, and the XNB file."""
+
+    load_dependencies()
+    with Output.open(extract_dir, pkg_name) as files:
+        if atlas.file:
+            data = Texture.read_dds(files.read(atlas.file.replace('\\', '/')),
+                format, width, height)
+        else:
+            width, height, pngs = atlas.repack(atlas.read_images(files),
+                width, height, repack)
+            data = Texture.from_rgba(format, width, height,
+                atlas.compose(pngs, width, height), quality, encoders)
+            del pngs
+    return atlas, Texture.build_xnb(format, width, height, data, compress)
+
+def recompress_png(file_path, max_size=PNG_RECOMPRESS_SIZE):
+    """Recompresses a PNG file with PIL's optimizer, if it's small enough.
+
+    The file is only replaced if the result is smaller.
+    Returns whether the file was replaced."""
+
+    try:
+        if os.path.getsize(file_path) > max_size:
+            return False
+        with open(file_path, 'rb') as f:
+            original = f.read()
+        data = BytesIO()
+        Image.open(BytesIO(original)).save(data, format='PNG', optimize=True)
+        if data.tell() >= len(original):
+            return False
+        write_file(file_path + '.tmp', data.getvalue())
+        os.replace(file_path + '.tmp', file_path)
+    except (OSError, IOError, ValueError):
+        raise GraphicsError('Failed to recompress {}.'.format(file_path))
+    return True
+
+def write_file(file_path, data):
+    """Writes data to a file."""
+
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+def match_name(name, patterns):
+    """Checks whether an asset name matches any of the glob patterns.
+
+    Backslashes in names and patterns are treated as path separators."""
+
+    name = name.replace('\\', '/')
+    for pattern in patterns:
+        if fnmatch(name, pattern.replace('\\', '/')):
+            return True
+    return False
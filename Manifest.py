@@ -0,0 +1,152 @@
+# BastionMod - Manifest
+# Keeps track of extracted files, so that unchanged inputs can be skipped.
+#
+# Copyright © 2013 Marc Gagné <gagne.marc@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the terms
+# of the Do What The Fuck You Want To Public License, Version 2, as published
+# by Sam Hocevar. See the COPYING file for more details.
+
+import hashlib
+import json
+import os
+
+from Common import *
+
+
+class Manifest:
+    """Records the inputs of a module's extraction and the outputs they
+    produced.
+
+    Each entry groups a set of input files with the output files extracted
+    from them, along with the options they were extracted with. An entry is
+    fresh if none of its inputs or options have changed and all of its
+    outputs still exist."""
+
+    FILE = 'manifest.json'
+    VERSION = 1
+
+    def __init__(self, extract_dir, force=False):
+        """Loads the manifest stored in the extract directory, if any.
+
+        If force is True, every entry is considered stale."""
+
+        self.extract_dir = extract_dir
+        self.file_path = os.path.join(extract_dir, Manifest.FILE)
+        self.force = force
+        self.entries = {}
+
+        try:
+            with open(self.file_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, IOError, ValueError):
+            return
+        if data.get('Version') == Manifest.VERSION:
+            self.entries = data['Entries']
+
+    def is_fresh(self, key, inputs, options=None):
+        """Checks whether the outputs of the entry are up to date.
+
+        options is a dict of the options which affect the outputs, if any.
+        Inputs whose modification time changed are hashed, so that files
+        which were only touched are still considered unchanged."""
+
+        entry = self.entries.get(key)
+        if self.force or not entry or entry.get('Options') != options:
+            return False
+        inputs = [os.path.abspath(p) for p in inputs]
+        if sorted(inputs) != sorted(entry['Inputs']):
+            return False
+
+        for path in inputs:
+            record = entry['Inputs'][path]
+            try:
+                stat = os.stat(path)
+            except (OSError, IOError):
+                return False
+            if stat.st_size != record['Size']:
+                return False
+            if stat.st_mtime_ns != record['MTime']:
+                if hash_file(path) != record['Hash']:
+                    return False
+                record['MTime'] = stat.st_mtime_ns
+
+        for output in entry['Outputs']:
+            if not os.path.exists(os.path.join(self.extract_dir, output)):
+                return False
+        return True
+
+    def update(self, key, inputs, outputs, options=None):
+        """Records the entry's inputs and options, and the outputs produced
+        from them.
+
+        Outputs which were produced previously but aren't anymore, such as
+        those of other options, are deleted, unless another entry still
+        produces them."""
+
+        old_outputs = set(self.entries.get(key, {}).get('Outputs', []))
+        records = {}
+        for path in inputs:
+            try:
+                stat = os.stat(path)
+            except (OSError, IOError):
+                raise BastionModError('Failed to read {}.'.format(path))
+            records[os.path.abspath(path)] = {
+                'Size': stat.st_size,
+                'MTime': stat.st_mtime_ns,
+                'Hash': hash_file(path)
+            }
+        self.entries[key] = {
+            'Inputs': records,
+            'Outputs': sorted(set(
+                os.path.relpath(p, self.extract_dir) for p in outputs))
+        }
+        if options is not None:
+            self.entries[key]['Options'] = options
+        self.remove_stale(old_outputs)
+
+    def remove(self, key):
+        """Removes an entry, along with its outputs which no other entry
+        produces."""
+
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.remove_stale(entry['Outputs'])
+
+    def remove_stale(self, outputs):
+        """Deletes the outputs which no entry produces anymore."""
+
+        produced = set()
+        for entry in self.entries.values():
+            produced.update(entry['Outputs'])
+        for output in set(outputs) - produced:
+            try:
+                os.remove(os.path.join(self.extract_dir, output))
+            except (OSError, IOError):
+                pass
+
+    def save(self):
+        """Saves the manifest to the extract directory."""
+
+        os.makedirs(self.extract_dir, exist_ok=True)
+        temp_path = '{}.tmp'.format(self.file_path)
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({
+                    'Version': Manifest.VERSION,
+                    'Entries': self.entries
+                }, f, indent=1, sort_keys=True)
+            os.replace(temp_path, self.file_path)
+        except (OSError, IOError):
+            raise BastionModError('Failed to write the manifest.')
+
+def hash_file(file_path):
+    """Hashes a file's contents with BLAKE2."""
+
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(0x100000), b''):
+                h.update(chunk)
+    except (OSError, IOError):
+        raise BastionModError('Failed to read {}.'.format(file_path))
+    return h.hexdigest()
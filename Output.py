@@ -0,0 +1,296 @@
+# BastionMod - Output
+# Stores extracted files in a directory tree or in a single archive.
+#
+# Copyright © 2013 Marc Gagné <gagne.marc@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the terms
+# of the Do What The Fuck You Want To Public License, Version 2, as published
+# by Sam Hocevar. See the COPYING file for more details.
+
+from io import BytesIO
+import os
+import tarfile
+from time import localtime, time
+import zipfile
+
+from Common import *
+
+
+class Output:
+    """Base class of the output backends.
+
+    Files are written by name, using '/' as the path separator. A backend
+    isn't thread-safe: all the files must be written from a single thread."""
+
+    KINDS = ('dir', 'zip', 'tar')
+
+    def __init__(self, path):
+        """Initializes the output, stored at path."""
+
+        self.path = path
+
+    @staticmethod
+    def create(kind, output_dir, name):
+        """Creates an output backend of the specified kind.
+
+        The 'dir' backend writes the files under output_dir, while the 'zip'
+        and 'tar' backends write them to the '<name>.zip' or '<name>.tar'
+        archive in output_dir."""
+
+        if kind == 'dir':
+            return DirOutput(output_dir)
+        elif kind == 'zip':
+            return ZipOutput(os.path.join(output_dir, name + '.zip'))
+        elif kind == 'tar':
+            return TarOutput(os.path.join(output_dir, name + '.tar'))
+        raise BastionModError('Unknown output kind: {}.'.format(kind))
+
+    @staticmethod
+    def open(output_dir, name):
+        """Opens the files written by any backend for reading.
+
+        The '<name>.zip' or '<name>.tar' archive is used if there is one,
+        otherwise the files are read from output_dir."""
+
+        path = os.path.join(output_dir, name)
+        if os.path.isfile(path + '.zip'):
+            return ZipReader(path + '.zip')
+        elif os.path.isfile(path + '.tar'):
+            return TarReader(path + '.tar')
+        return DirReader(output_dir)
+
+    @staticmethod
+    def remove_archives(output_dir, name, keep=None):
+        """Deletes the '<name>.zip' and '<name>.tar' archives in output_dir,
+        except the one of the kind keep.
+
+        Output.open() reads an archive before the directory: those of other
+        backends must be removed once the files are written again."""
+
+        for kind in ('zip', 'tar'):
+            if kind != keep:
+                try:
+                    os.remove(os.path.join(output_dir, name + '.' + kind))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    raise BastionModError('Failed to remove {}.{}.'.format(
+                        name, kind))
+
+    def write(self, name, data):
+        """Writes a file. To be extended by sub-classes."""
+
+    def close(self):
+        """Finishes writing the files. To be extended by sub-classes.
+
+        Returns the paths of the files which were written on disk."""
+
+        return []
+
+    def abort(self):
+        """Stops writing the files, after an error."""
+
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DirOutput(Output):
+    """Writes each file to its own path under a directory."""
+
+    def __init__(self, path):
+        """Initializes the output."""
+
+        super().__init__(path)
+        self.dirs = set()
+        self.written = []
+
+    def write(self, name, data):
+        """Writes a file, creating its directory if needed."""
+
+        file_path = os.path.join(self.path, name).replace('\\', '/')
+        dir_path = os.path.dirname(file_path)
+        if dir_path not in self.dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self.dirs.add(dir_path)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        self.written.append(file_path)
+
+    def close(self):
+        """Returns the paths of the files which were written."""
+
+        return self.written
+
+
+class ArchiveOutput(Output):
+    """Base class of the archive backends.
+
+    The archive is written to a temporary file, which replaces the previous
+    archive once closed."""
+
+    def __init__(self, path):
+        """Opens the temporary archive."""
+
+        super().__init__(path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.tmp_path = path + '.tmp'
+        self.archive = self.open_archive(self.tmp_path)
+        self.closed = False
+
+    def open_archive(self, file_path):
+        """Opens the archive for writing. To be extended by sub-classes."""
+
+    def close(self):
+        """Closes the archive and moves it to its final path."""
+
+        if not self.closed:
+            self.closed = True
+            self.archive.close()
+            os.replace(self.tmp_path, self.path)
+        return [self.path]
+
+    def abort(self):
+        """Closes and removes the temporary archive."""
+
+        if not self.closed:
+            self.closed = True
+            self.archive.close()
+            os.remove(self.tmp_path)
+
+
+class ZipOutput(ArchiveOutput):
+    """Writes the files to a zip archive.
+
+    The files are stored uncompressed, as they usually already are."""
+
+    def open_archive(self, file_path):
+        """Opens the zip archive for writing."""
+
+        return zipfile.ZipFile(file_path, 'w', zipfile.ZIP_STORED)
+
+    def write(self, name, data):
+        """Adds a file to the archive."""
+
+        info = zipfile.ZipInfo(name, localtime()[:6])
+        self.archive.writestr(info, data)
+
+
+class TarOutput(ArchiveOutput):
+    """Writes the files to an uncompressed tar archive."""
+
+    def open_archive(self, file_path):
+        """Opens the tar archive for writing."""
+
+        return tarfile.open(file_path, 'w')
+
+    def write(self, name, data):
+        """Adds a file to the archive."""
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time()
+        self.archive.addfile(info, BytesIO(data))
+
+
+class DirReader:
+    """Reads the files written by a DirOutput."""
+
+    def __init__(self, path):
+        """Initializes the reader."""
+
+        self.path = path
+
+    def names(self):
+        """Returns the names of the files."""
+
+        names = []
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            rel_path = os.path.relpath(dir_path, self.path)
+            for file_name in file_names:
+                names.append(os.path.normpath(os.path.join(rel_path,
+                    file_name)).replace(os.sep, '/'))
+        return sorted(names)
+
+    def read(self, name):
+        """Returns a file's data."""
+
+        try:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                return f.read()
+        except (OSError, IOError):
+            raise BastionModError('Failed to read {}.'.format(name))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ZipReader(DirReader):
+    """Reads the files written by a ZipOutput."""
+
+    def __init__(self, path):
+        """Opens the archive."""
+
+        super().__init__(path)
+        try:
+            self.archive = zipfile.ZipFile(path, 'r')
+        except (OSError, IOError, zipfile.BadZipFile):
+            raise BastionModError('Failed to open {}.'.format(path))
+
+    def names(self):
+        """Returns the names of the files."""
+
+        return sorted(self.archive.namelist())
+
+    def read(self, name):
+        """Returns a file's data."""
+
+        try:
+            return self.archive.read(name)
+        except KeyError:
+            raise BastionModError('Failed to read {}.'.format(name))
+
+    def close(self):
+        """Closes the archive."""
+
+        self.archive.close()
+
+
+class TarReader(DirReader):
+    """Reads the files written by a TarOutput."""
+
+    def __init__(self, path):
+        """Opens the archive."""
+
+        super().__init__(path)
+        try:
+            self.archive = tarfile.open(path, 'r')
+        except (OSError, IOError, tarfile.TarError):
+            raise BastionModError('Failed to open {}.'.format(path))
+
+    def names(self):
+        """Returns the names of the files."""
+
+        return sorted(self.archive.getnames())
+
+    def read(self, name):
+        """Returns a file's data."""
+
+        try:
+            return self.archive.extractfile(name).read()
+        except (KeyError, AttributeError):
+            raise BastionModError('Failed to read {}.'.format(name))
+
+    def close(self):
+        """Closes the archive."""
+
+        self.archive.close()
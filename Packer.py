@@ -0,0 +1,271 @@
+# BastionMod - Packer
+# Packs images into the atlases' textures.
+#
+# Copyright © 2013 Marc Gagné <gagne.marc@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the terms
+# of the Do What The Fuck You Want To Public License, Version 2, as published
+# by Sam Hocevar. See the COPYING file for more details.
+
+from Common import *
+
+# Largest texture supported by XNA's HiDef profile.
+MAX_TEXTURE_SIZE = 4096
+# Transparent pixels kept between the images, so that they don't bleed into
+# each other when filtered.
+PADDING = 1
+
+
+class Skyline:
+    """Bin filled from the bottom up, only keeping track of its skyline.
+
+    The skyline is a list of [x, y, width] segments, from left to right.
+    Each rectangle is inserted where its top ends up the lowest (bottom-left
+    rule). Space below the skyline is lost, which makes it both faster and
+    looser than MaxRects: it suits full repacks."""
+
+    def __init__(self, width, height):
+        """Initializes the empty bin."""
+
+        self.width = width
+        self.height = height
+        self.segments = [[0, 0, width]]
+
+    def find(self, width, height):
+        """Returns the index of the segment a rectangle would start on, and
+        its position. Returns None if it doesn't fit."""
+
+        segments = self.segments
+        best = None
+        best_top = self.height - height + 1
+        for i, (x, y, w) in enumerate(segments):
+            if x + width > self.width:
+                break
+            # The rectangle rests on the highest segment under it.
+            j = i
+            end = x + width
+            while x + w < end:
+                j += 1
+                seg_y = segments[j][1]
+                if seg_y > y:
+                    y = seg_y
+                    if y >= best_top:
+                        break
+                w = segments[j][0] + segments[j][2] - x
+            if y < best_top:
+                best = (i, (x, y))
+                best_top = y
+        return best
+
+    def insert(self, width, height):
+        """Inserts a rectangle, returning its position.
+
+        Returns None if it doesn't fit."""
+
+        found = self.find(width, height)
+        if not found:
+            return None
+        i, (x, y) = found
+
+        # Replace the segments under the rectangle by its top.
+        segments = self.segments
+        end = x + width
+        while i < len(segments) and segments[i][0] < end:
+            seg_x, seg_y, seg_w = segments[i]
+            if seg_x + seg_w <= end:
+                del segments[i]
+            else:
+                segments[i] = [end, seg_y, seg_x + seg_w - end]
+                break
+        segments.insert(i, [x, y + height, width])
+
+        # Merge it with its neighbours at the same height.
+        if i + 1 < len(segments) and segments[i + 1][1] == y + height:
+            segments[i][2] += segments.pop(i + 1)[2]
+        if i > 0 and segments[i - 1][1] == y + height:
+            segments[i - 1][2] += segments.pop(i)[2]
+        return x, y
+
+
+class MaxRects:
+    """Free space of a bin, kept as the list of its maximal free rectangles.
+
+    Rectangles are (x, y, width, height) tuples. Each rectangle is inserted
+    where it leaves the shortest remaining side of its free rectangle the
+    smallest (best short side fit). The bin can be seeded with rectangles
+    which are already placed: it suits incremental repacks."""
+
+    def __init__(self, width, height):
+        """Initializes the empty bin."""
+
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+
+    def fill(self, rects):
+        """Marks rectangles as used.
+
+        The rectangles are swept from top to bottom: free rectangles above
+        the sweep line can't be split anymore, and are set aside meanwhile,
+        so that each rectangle only goes through the ones crossing it."""
+
+        done = []
+        for x, y, width, height in sorted(rects, key=lambda r: r[1]):
+            active = []
+            for f in self.free:
+                (active if f[1] + f[3] > y else done).append(f)
+            self.free = active
+            self.occupy(x, y, width, height)
+        self.free += done
+
+    def find(self, width, height):
+        """Returns the best position of a rectangle, or None if it doesn't
+        fit."""
+
+        best = None
+        best_short = best_long = None
+        for x, y, w, h in self.free:
+            if w < width or h < height:
+                continue
+            short, long = sorted((w - width, h - height))
+            if best is None or (short, long) < (best_short, best_long):
+                best = (x, y)
+                best_short, best_long = short, long
+                if not long:
+                    break
+        return best
+
+    def insert(self, width, height):
+        """Inserts a rectangle, returning its position.
+
+        Returns None if it doesn't fit."""
+
+        pos = self.find(width, height)
+        if pos:
+            self.occupy(pos[0], pos[1], width, height)
+        return pos
+
+    def occupy(self, x, y, width, height):
+        """Marks a rectangle as used, splitting the free rectangles it
+        overlaps."""
+
+        right = x + width
+        bottom = y + height
+        kept = []
+        split = []
+        for f in self.free:
+            fx, fy, fw, fh = f
+            f_right = fx + fw
+            f_bottom = fy + fh
+            if (x >= f_right or right <= fx or y >= f_bottom or
+                    bottom <= fy):
+                kept.append(f)
+                continue
+            if x > fx:
+                split.append((fx, fy, x - fx, fh))
+            if right < f_right:
+                split.append((right, fy, f_right - right, fh))
+            if y > fy:
+                split.append((fx, fy, fw, y - fy))
+            if bottom < f_bottom:
+                split.append((fx, bottom, fw, f_bottom - bottom))
+
+        # Drop the new rectangles contained in other ones. The others can't
+        # be contained in new ones, as those come from overlapped rectangles.
+        pruned = []
+        for i, (sx, sy, sw, sh) in enumerate(split):
+            s_right = sx + sw
+            s_bottom = sy + sh
+            for j, (ox, oy, ow, oh) in enumerate(split):
+                if (i != j and ox <= sx and oy <= sy and
+                        ox + ow >= s_right and oy + oh >= s_bottom and
+                        ((ox, oy, ow, oh) != (sx, sy, sw, sh) or j < i)):
+                    break
+            else:
+                for ox, oy, ow, oh in kept:
+                    if (ox <= sx and oy <= sy and ox + ow >= s_right and
+                            oy + oh >= s_bottom):
+                        break
+                else:
+                    pruned.append((sx, sy, sw, sh))
+        self.free = kept + pruned
+
+
+def pack_rects(sizes, width, height, fixed=None, padding=PADDING):
+    """Packs rectangles into a texture of the specified dimensions.
+
+    sizes is the list of the rectangles' (width, height), and fixed maps the
+    indices of the rectangles which must stay where they are to their
+    position. The others are inserted from the largest to the smallest, in
+    a Skyline bin, or a MaxRects one around the fixed rectangles.
+
+    Returns the position of each rectangle, or None if they don't all
+    fit."""
+
+    fixed = fixed or {}
+    # The padding is added to the right and bottom of each rectangle: the
+    # bin is enlarged as much, so that no padding is needed at its edges.
+    positions = [None] * len(sizes)
+    if fixed:
+        bin = MaxRects(width + padding, height + padding)
+        bin.fill([(pos[0], pos[1], sizes[i][0] + padding,
+            sizes[i][1] + padding) for i, pos in sorted(fixed.items())
+            if sizes[i][0] and sizes[i][1]])
+        for i, pos in fixed.items():
+            positions[i] = pos
+    else:
+        bin = Skyline(width + padding, height + padding)
+
+    order = sorted((i for i in range(len(sizes)) if i not in fixed),
+        key=lambda i: (-sizes[i][1], -sizes[i][0], i))
+    for i in order:
+        w, h = sizes[i]
+        if not w or not h:
+            positions[i] = (0, 0)
+            continue
+        pos = bin.insert(w + padding, h + padding)
+        if pos is None:
+            return None
+        positions[i] = pos
+    return positions
+
+def fit_rects(sizes, width, height, fixed=None, max_size=MAX_TEXTURE_SIZE,
+    padding=PADDING):
+    """Packs rectangles into a texture, enlarging it until they fit.
+
+    The texture starts at the specified dimensions, and its smallest side is
+    doubled each time the rectangles don't fit, up to max_size.
+    Returns the texture's final dimensions and the rectangles' positions."""
+
+    for w, h in sizes:
+        if w > max_size or h > max_size:
+            raise GraphicsError('Image larger than {0}x{0}.'.format(max_size))
+    while True:
+        positions = pack_rects(sizes, width, height, fixed, padding)
+        if positions is not None:
+            return width, height, positions
+        if width >= max_size and height >= max_size:
+            raise GraphicsError('Images don\'t fit in a {0}x{0} texture.'
+                .format(max_size))
+        if (width <= height or height >= max_size) and width < max_size:
+            width = min(2 * width, max_size)
+        else:
+            height = min(2 * height, max_size)
+
+def min_texture_size(sizes, padding=PADDING):
+    """Returns the smallest power-of-two dimensions which may hold the
+    rectangles: their area and sides must all fit."""
+
+    area = sum((w + padding) * (h + padding) for w, h in sizes if w and h)
+    width = height = 1
+    max_w = max([w for w, h in sizes] + [1])
+    max_h = max([h for w, h in sizes] + [1])
+    while width < max_w:
+        width *= 2
+    while height < max_h:
+        height *= 2
+    while width * height < area:
+        if width <= height:
+            width *= 2
+        else:
+            height *= 2
+    return width, height
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# BastionMod - Benchmark SoundBank
+# Measures how long parsing and saving a large synthetic sound bank take.
+#
+# Copyright © 2013 Marc Gagné <gagne.marc@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the terms
+# of the Do What The Fuck You Want To Public License, Version 2, as published
+# by Sam Hocevar. See the COPYING file for more details.
+
+from argparse import ArgumentParser
+import os
+import random
+import struct
+import tempfile
+from time import perf_counter
+
+from Audio import *
+
+
+def best_time(function, runs):
+    """Returns the best time of several runs of the function."""
+
+    times = []
+    for r in range(runs):
+        start_time = perf_counter()
+        function()
+        times.append(perf_counter() - start_time)
+    return min(times)
+
+def build_xsb(num_sounds, seed=0):
+    """Builds the data of a synthetic XSB file.
+
+    Its sounds have one to three entries of one to four files each, a few
+    properties, and are named in pairs, like Bastion's. The bytes after the
+    file ids and the order of the name table are random, so that they must
+    be kept to write the file back."""
+
+    rnd = random.Random(seed)
+    data = bytearray(struct.pack('<IQ', SoundBank.VERSION, num_sounds))
+    banks = ('Sounds', 'Music', 'StreamingWaveBank')
+    for i in range(num_sounds):
+        data += bytes(8)
+        entries_num = rnd.randint(1, 3)
+        data += struct.pack('<I', entries_num)
+        for e in range(entries_num):
+            files_num = rnd.randint(1, 4)
+            data += struct.pack('<I', files_num)
+            for f_i in range(files_num):
+                data += pack_string(rnd.choice(banks), 2)
+                data += struct.pack('<IB', rnd.randrange(1000),
+                    rnd.randrange(256))
+            data += bytes(0x2A)
+        data += pack_string(rnd.choice(('Music', 'Narration', 'Effects')), 2)
+        properties_num = rnd.randint(0, 3)
+        data += struct.pack('<I', properties_num)
+        for prop in range(properties_num):
+            data += pack_string('Property{}'.format(prop), 2)
+        data += pack_string('Reverb', 2)
+        data += bytes(4)
+    pairs = list(range(0, num_sounds, 2))
+    rnd.shuffle(pairs)
+    for i in pairs:
+        data_nums = list(range(i, min(i + 2, num_sounds)))
+        if rnd.randrange(2):
+            data_nums.reverse()
+        data += pack_string('Sound{}'.format(i // 2), 2)
+        data += bytes(4)
+        data += struct.pack('<{}I'.format(len(data_nums) + 1),
+            len(data_nums), *data_nums)
+        data += bytes(4)
+    return bytes(data)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Benchmarks the sound bank parsers.')
+    parser.add_argument('-n', type=int, default=50000, metavar='SOUNDS',
+        help='Number of sounds in the sound bank (default: 50000).')
+    parser.add_argument('-r', type=int, default=5, metavar='RUNS',
+        help='Number of runs, the best one being kept (default: 5).')
+    args = parser.parse_args()
+
+    data = build_xsb(args.n)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        xsb_path = os.path.join(tmp_dir, SoundBank.FILE)
+        xml_path = os.path.join(tmp_dir, 'SoundBank.xml')
+        with open(xsb_path, 'wb') as f:
+            f.write(data)
+        sound_bank = SoundBank(xsb_path)
+        sound_bank.save_xml(xml_path)
+
+        print('{} sounds, {} bytes.'.format(args.n, len(data)))
+        for name, function in (
+                ('Parse XSB', lambda: SoundBank(xsb_path)),
+                ('Parse XML', lambda: SoundBank(xml_path)),
+                ('Save XSB', lambda: sound_bank.save_xsb(xsb_path))):
+            best = best_time(function, args.r)
+            print('{}: {:.3f}s ({:.0f} sounds/s)'.format(name, best,
+                args.n / best))